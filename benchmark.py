@@ -0,0 +1,162 @@
+""" end-to-end benchmark of fingerprint() against the mock server stack, no network needed """
+
+import json
+import random
+import sys
+import time
+import configargparse
+from mockserver import MockServer, HOSTNAME
+from repository import get_repository
+from transport import Session
+from untangle import ScanContext, fingerprint
+
+DEFAULT_CHAINS = [["cloudflare", "nginx", "tomcat"], ["fastly", "varnish", "apache"],
+                  ["cloudfront", "nginx"], ["akamai", "apache"], ["nginx"], ["envoy", "caddy"],
+                  ["haproxy", "squid", "tomcat"], ["ats"]]
+
+
+def percentile(values, fraction):
+    """ nearest-rank percentile """
+
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def flatten(layers):
+    """ puts the unordered layers in line with the ordered ones """
+
+    flat = []
+    for layer in layers:
+        if isinstance(layer, list):
+            flat.extend(layer)
+        else:
+            flat.append(layer)
+    return flat
+
+
+def run_chain(chain, repository, session, repeat, context_options):
+    """ fingerprints a mock chain repeat times, returns a record per run """
+
+    records = []
+    with MockServer(chain, repository) as mock:
+        for _ in range(repeat):
+            before = mock.requests
+            start = time.perf_counter()
+            context = ScanContext(session=session, repository=repository, **context_options)
+            layers = fingerprint(HOSTNAME, mock.port, context)
+            latency = time.perf_counter() - start
+
+            found = flatten(layers)
+            records.append({
+                "chain": chain,
+                "layers": layers,
+                "confidence": context.confidences,
+                "probes": mock.requests - before,
+                "latency": latency,
+                "exact": found[:len(chain)] == chain,
+                "correct_layers": sum(1 for expected, server in zip(chain, found)
+                                      if expected == server),
+            })
+    return records
+
+
+def summarize(records, elapsed):
+    """ probes, latency percentiles, throughput and accuracy of the runs """
+
+    latencies = [record["latency"] for record in records]
+    layers = sum(len(record["chain"]) for record in records)
+    return {
+        "runs": len(records),
+        "probes_mean": sum(record["probes"] for record in records) / len(records),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p90": percentile(latencies, 0.90),
+        "latency_p99": percentile(latencies, 0.99),
+        "throughput": len(records) / elapsed if elapsed > 0 else 0.0,
+        "accuracy": sum(record["exact"] for record in records) / len(records),
+        "layer_accuracy": sum(record["correct_layers"] for record in records) / layers,
+    }
+
+
+def compare(summary, baseline, tolerance):
+    """ returns the metrics that regressed compared to a baseline summary """
+
+    regressions = []
+    for metric in ("probes_mean", "latency_p50", "latency_p90"):
+        if summary[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f"{metric}: {baseline[metric]:.4f} -> {summary[metric]:.4f}")
+    for metric in ("accuracy", "layer_accuracy"):
+        if summary[metric] < baseline[metric]:
+            regressions.append(f"{metric}: {baseline[metric]:.4f} -> {summary[metric]:.4f}")
+    return regressions
+
+
+def parse_chains(arg, server_list):
+    """ chains given as cloudflare,nginx,tomcat;fastly,varnish, or random ones """
+
+    if arg.random:
+        generator = random.Random(arg.seed)
+        return [generator.sample(server_list, generator.randint(1, 3))
+                for _ in range(arg.random)]
+    if arg.chains:
+        return [chain.split(",") for chain in arg.chains.split(";")]
+    return DEFAULT_CHAINS
+
+
+def main():
+    """ runs the benchmark """
+
+    parser = configargparse.ArgParser(description='Untangle benchmark on mock server stacks.')
+    parser.add('--chains', dest="chains", type=str,
+               help="Chains to emulate, e.g. cloudflare,nginx,tomcat;fastly,varnish")
+    parser.add('--random', dest="random", type=int, default=0,
+               help="Emulate this many random chains of 1 to 3 servers instead.")
+    parser.add('--seed', dest="seed", type=int, default=0, help="Seed of the random chains.")
+    parser.add('--repeat', dest="repeat", type=int, default=3,
+               help="Number of fingerprints per chain.")
+    parser.add('-r', dest="repository", type=str, help="Behavior repository to use.")
+    parser.add('--in-flight', dest="max_in_flight", type=int, default=8,
+               help="Maximum number of probes in flight in Phase 2 and Phase 3.")
+    parser.add('--adaptive', dest="adaptive", action="store_true",
+               help="Use the adaptive Phase 2 probe selection.")
+    parser.add('--confidence', dest="confidence", type=float, default=0,
+               help="Confidence at which Phase 2 and Phase 3 stop probing a layer.")
+    parser.add('-o', dest="output", type=str, help="Write the summary and the runs as JSON.")
+    parser.add('--baseline', dest="baseline", type=str,
+               help="JSON written by -o in a previous run to check for regressions.")
+    parser.add('--tolerance', dest="tolerance", type=float, default=0.2,
+               help="Allowed relative increase of the probes and latencies.")
+    arg = parser.parse_args()
+
+    repository = get_repository(arg.repository)
+    session = Session()
+    context_options = {"max_in_flight": arg.max_in_flight, "adaptive": arg.adaptive,
+                       "confidence": arg.confidence}
+
+    records = []
+    start = time.perf_counter()
+    for chain in parse_chains(arg, repository.server_list):
+        records.extend(run_chain(chain, repository, session, arg.repeat, context_options))
+    summary = summarize(records, time.perf_counter() - start)
+
+    print(f"runs: {summary['runs']}, probes/run: {summary['probes_mean']:.1f}, "
+          f"latency p50/p90/p99: {summary['latency_p50']:.3f}/{summary['latency_p90']:.3f}/"
+          f"{summary['latency_p99']:.3f} s, throughput: {summary['throughput']:.2f} runs/s, "
+          f"accuracy: {summary['accuracy']:.2%} (layers {summary['layer_accuracy']:.2%})")
+
+    if arg.output:
+        with open(arg.output, "w", encoding="utf-8") as writer:
+            json.dump({"summary": summary, "runs": records}, writer, indent=1)
+
+    if arg.baseline:
+        with open(arg.baseline, "r", encoding="utf-8") as reader:
+            regressions = compare(summary, json.load(reader)["summary"], arg.tolerance)
+        for regression in regressions:
+            print("regression", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
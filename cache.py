@@ -0,0 +1,174 @@
+""" caches of the probe responses and of the scan results """
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 300
+RESULT_CACHE_TTL = 7 * 24 * 3600
+
+
+class ResponseCache():
+    """
+        LRU cache with a TTL for the raw responses of a scan, keyed by
+        (host, port, path, request bytes). Concurrent probes with the same
+        key wait for the first one instead of sending the request again.
+    """
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (response, expiry time), least recently used first.
+        self.entries = OrderedDict()
+        # key -> event set when the probe that is sending the key finishes.
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        """ returns the cached response or None, must hold the lock """
+
+        cached = self.entries.get(key)
+        if cached is None:
+            return None
+        if cached[1] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return cached[0]
+
+    def _store(self, key, response):
+        """ stores a response and evicts the least recently used ones, must hold the lock """
+
+        self.entries[key] = (response, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def fetch(self, key, send):
+        """
+            Returns the cached response of the key, else calls send and caches
+            its result. Only byte responses are cached, so timeouts and
+            exceptions are retried by the next probe.
+        """
+
+        if self.max_entries <= 0:
+            with self.lock:
+                self.misses += 1
+            return send()
+
+        with self.lock:
+            response = self._lookup(key)
+            if response is not None:
+                self.hits += 1
+                return response
+
+            pending = self.pending.get(key)
+            if pending is None:
+                pending = threading.Event()
+                self.pending[key] = pending
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            pending.wait()
+            with self.lock:
+                response = self._lookup(key)
+                if response is not None:
+                    self.hits += 1
+                    return response
+
+        with self.lock:
+            self.misses += 1
+
+        try:
+            response = send()
+            if isinstance(response, bytes):
+                with self.lock:
+                    self._store(key, response)
+            return response
+        finally:
+            if owner:
+                with self.lock:
+                    del self.pending[key]
+                pending.set()
+
+
+class ResultCache():
+    """
+        Persistent SQLite cache of the fingerprinted chains, keyed by the
+        hostname, port and path that the initial redirect check resolved to.
+        A row holds the layers, and the Phase 1 probes (target reaction vector
+        and outcome) that found them, so a rescan can verify the chain with a
+        couple of these probes instead of discovering it again. The expired
+        rows are deleted when the cache is opened. Safe to share between
+        threads and processes.
+    """
+    def __init__(self, path, ttl=RESULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " host TEXT NOT NULL, port INTEGER NOT NULL, path TEXT NOT NULL,"
+                " layers TEXT NOT NULL, probes TEXT NOT NULL, scanned_at REAL NOT NULL,"
+                " PRIMARY KEY (host, port, path))")
+        # the rows of the targets that are not scanned again would stay forever.
+        self.purge()
+
+    @staticmethod
+    def _key(host, port, path):
+        if not isinstance(host, str):
+            host = host.decode()
+        if not isinstance(path, str):
+            path = path.decode()
+        return host.lower(), port, path
+
+    def get(self, host, port, path):
+        """
+            Returns the cached (layers, probes) of a target, None when it is
+            not cached or older than the TTL. probes is a list of
+            (target reaction tuple, outcome).
+        """
+
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT layers, probes, scanned_at FROM results"
+                " WHERE host = ? AND port = ? AND path = ?",
+                self._key(host, port, path)).fetchone()
+
+        if row is None or row[2] + self.ttl <= time.time():
+            return None
+        return json.loads(row[0]), [(tuple(reaction), outcome)
+                                    for reaction, outcome in json.loads(row[1])]
+
+    def put(self, host, port, path, layers, probes):
+        """ stores the layers of a target and the Phase 1 probes that found them """
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                self._key(host, port, path) + (json.dumps(layers),
+                                               json.dumps([[list(reaction), outcome]
+                                                           for reaction, outcome in probes]),
+                                               time.time()))
+
+    def purge(self):
+        """ deletes the rows older than the TTL, returns how many """
+
+        with self.lock, self.connection:
+            return self.connection.execute("DELETE FROM results WHERE scanned_at <= ?",
+                                           (time.time() - self.ttl,)).rowcount
+
+    def close(self):
+        """ closes the database """
+
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,122 @@
+"""
+    offline check of the framing-aware response reader. Every response is
+    fed whole, byte by byte and split in two at every position, and the
+    reader has to stop where the framing says without reading any further.
+    Run from the repository root: python checks/check_framer.py
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import ResponseFramer, read_response_stream, read_response_stream_async, MAX_HEAD
+
+CONTENT_LENGTH = b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"
+CHUNKED = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+           b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\n\r\n")
+UNTIL_CLOSE = b"HTTP/1.1 200 OK\r\nServer: x\r\n\r\nhello world"
+
+# name, response, max_body, whether the server closes after it, expected result, reusable
+CASES = [
+    ("content-length", CONTENT_LENGTH, 65536, False, CONTENT_LENGTH, True),
+    ("content-length empty", b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", 65536, False,
+     b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", True),
+    ("connection close", b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 2\r\n\r\nok",
+     65536, False, b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 2\r\n\r\nok", False),
+    ("http/1.0", b"HTTP/1.0 200 OK\r\nContent-Length: 2\r\n\r\nok", 65536, False,
+     b"HTTP/1.0 200 OK\r\nContent-Length: 2\r\n\r\nok", False),
+    ("chunked", CHUNKED, 65536, False, CHUNKED, True),
+    ("chunked trailer", CHUNKED[:-2] + b"X-Trailer: 1\r\n\r\n", 65536, False,
+     CHUNKED[:-2] + b"X-Trailer: 1\r\n\r\n", True),
+    ("chunked over content-length",
+     b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nContent-Length: 99\r\n\r\n2\r\nok\r\n0\r\n\r\n",
+     65536, False,
+     b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nContent-Length: 99\r\n\r\n2\r\nok\r\n0\r\n\r\n",
+     True),
+    ("100 continue", b"HTTP/1.1 100 Continue\r\n\r\n" + CONTENT_LENGTH, 65536, False,
+     b"HTTP/1.1 100 Continue\r\n\r\n" + CONTENT_LENGTH, True),
+    ("two 1xx", b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 103 Early Hints\r\nLink: </a>\r\n\r\n" + CHUNKED,
+     65536, False,
+     b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 103 Early Hints\r\nLink: </a>\r\n\r\n" + CHUNKED, True),
+    ("204", b"HTTP/1.1 204 No Content\r\nContent-Length: 10\r\n\r\n", 65536, False,
+     b"HTTP/1.1 204 No Content\r\nContent-Length: 10\r\n\r\n", True),
+    ("304", b"HTTP/1.1 304 Not Modified\r\nTransfer-Encoding: chunked\r\n\r\n", 65536, False,
+     b"HTTP/1.1 304 Not Modified\r\nTransfer-Encoding: chunked\r\n\r\n", True),
+    ("until close", UNTIL_CLOSE, 65536, True, UNTIL_CLOSE, False),
+    ("bad content-length", b"HTTP/1.1 200 OK\r\nContent-Length: x\r\n\r\nhello", 65536, True,
+     b"HTTP/1.1 200 OK\r\nContent-Length: x\r\n\r\nhello", False),
+    ("bad status line", b"HTTP/1.1\r\nContent-Length: 1\r\n\r\nhello", 65536, True,
+     b"HTTP/1.1\r\nContent-Length: 1\r\n\r\nhello", False),
+    ("short content-length", CONTENT_LENGTH[:-2], 65536, True, CONTENT_LENGTH[:-2], False),
+    ("max_body content-length", b"HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\nhello world", 5, False,
+     b"HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\nhello", False),
+    ("max_body chunked", CHUNKED, 4, False, CHUNKED[:CHUNKED.index(b"\r\n\r\n") + 8], False),
+    ("max_body until close", UNTIL_CLOSE, 5, False, UNTIL_CLOSE[:-6], False),
+    ("max_head", b"HTTP/1.1 200 OK\r\nX: " + b"a" * MAX_HEAD, 65536, False,
+     (b"HTTP/1.1 200 OK\r\nX: " + b"a" * MAX_HEAD)[:MAX_HEAD], False),
+]
+
+
+class FakeSocket():
+    """ hands out the pieces of a response, fails when read past them on an open connection """
+    def __init__(self, pieces, closes):
+        self.pieces = list(pieces)
+        self.closes = closes
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, buffer):
+        if not self.pieces:
+            assert self.closes, "read past the end of the response"
+            return 0
+        piece = self.pieces.pop(0)
+        if len(piece) > len(buffer):
+            piece, rest = piece[:len(buffer)], piece[len(buffer):]
+            self.pieces.insert(0, rest)
+        buffer[:len(piece)] = piece
+        return len(piece)
+
+
+def splits(response):
+    """ the response whole, byte by byte and cut in two at every position """
+
+    yield [response]
+    if len(response) > 4096:
+        return
+    yield [response[i:i + 1] for i in range(len(response))]
+    for i in range(1, len(response)):
+        yield [response[:i], response[i:]]
+
+
+async def read_async(pieces, closes, max_body):
+    """ feeds the pieces to a StreamReader and reads them with the asyncio reader """
+
+    reader = asyncio.StreamReader()
+    for piece in pieces:
+        reader.feed_data(piece)
+    if closes:
+        reader.feed_eof()
+    return await read_response_stream_async(reader, timeout=1, max_body=max_body)
+
+
+def main():
+    reads = 0
+    for name, response, max_body, closes, expected, reusable in CASES:
+        for pieces in splits(response):
+            framer = ResponseFramer(max_body)
+            result = read_response_stream(FakeSocket(pieces, closes), max_body, framer=framer)
+            assert result == expected, "%s: read %r" % (name, result)
+            assert framer.reusable() == reusable, "%s: reusable is %s" % (name, framer.reusable())
+            reads += 1
+
+        result = asyncio.run(read_async([response], closes, max_body))
+        assert result == expected, "%s: read %r asynchronously" % (name, result)
+
+    print("the framer read %d responses as expected" % reads)
+
+
+if __name__ == "__main__":
+    main()
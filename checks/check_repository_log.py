@@ -0,0 +1,205 @@
+"""
+    offline check of the repository log. A log is written from the shipped
+    repository, entries, a server column and re-measured entries are appended
+    to it, and after every refresh() the results of pick and query are
+    compared with the expected ones, while reader threads pick and query the
+    repository as the scans do.
+    Run from the repository root: python checks/check_repository_log.py
+"""
+
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import (BehaviorRepository, append_log, append_repository, entry_records,
+                        log_record, read_pickle, write_log, UNKNOWN)
+
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               "behavior_repository.out")
+
+
+def requests(entry):
+    """ the requests of an entry list, in order """
+
+    return [resp.after_mut for _, resp in entry]
+
+
+def query_keys(repository, forwarding=(), erroring=()):
+    """ the reaction vectors that query returns """
+
+    return [reaction for reaction, _ in repository.query(forwarding, erroring)]
+
+
+def expected_keys(entries, forwarding=(), erroring=()):
+    """ the reaction vectors query should return, UNKNOWN matches both reactions """
+
+    return [reaction for reaction in entries
+            if all(value in (0, 1, UNKNOWN) for value in reaction)
+            and all(reaction[idx] in (1, UNKNOWN) for idx in forwarding)
+            and all(reaction[idx] in (0, UNKNOWN) for idx in erroring)]
+
+
+def check_queries(repository, entries):
+    """ query matches the expected keys for every single server and a few pairs """
+
+    servers = range(len(repository.server_list))
+    assert query_keys(repository) == expected_keys(entries)
+    for idx in servers:
+        assert query_keys(repository, [idx]) == expected_keys(entries, [idx]), idx
+        assert query_keys(repository, (), [idx]) == expected_keys(entries, (), [idx]), idx
+    for idx in servers:
+        pair = [idx, (idx + 1) % len(servers)]
+        assert query_keys(repository, pair[:1], pair[1:]) == \
+            expected_keys(entries, pair[:1], pair[1:]), pair
+
+
+def check_log(directory, original):
+    path = os.path.join(directory, "behavior_repository.jsonl")
+    write_log(original, path)
+    repository = BehaviorRepository.load(path)
+    keys = list(original)
+    assert list(repository.entries) == keys
+    for reaction in keys:
+        assert requests(repository.pick(reaction)) == requests(original[reaction]), reaction
+    check_queries(repository, original)
+
+    # an entry with a new reaction vector and one more request for an existing one.
+    first, second = keys[0], keys[1]
+    new = tuple(1 - value if idx == 0 else value for idx, value in enumerate(first))
+    assert new not in original
+    before = repository.state
+    append_log(path, entry_records(new, original[first][:1])
+               + entry_records(second, [(99, original[first][0][1])]))
+    assert repository.refresh() == 2
+    assert requests(repository.pick(new)) == requests(original[first][:1])
+    assert requests(repository.pick(second)) == requests(original[second]) + \
+        [original[first][0][1].after_mut]
+    # the published state is not changed by the refresh.
+    assert new not in before.entries and len(before.entries[second]) == len(original[second])
+    expected = dict(original)
+    expected[new] = original[first][:1]
+    expected[second] = original[second] + [(99, original[first][0][1])]
+    check_queries(repository, expected)
+
+    # a record without its newline is applied once it is complete.
+    line = log_record("drop", reaction=list(new))
+    append_log(path, [line[:-5]])
+    assert repository.refresh() == 0
+    append_log(path, [line[-5:]])
+    assert repository.refresh() == 1
+    assert repository.pick(new) is False
+    del expected[new]
+    check_queries(repository, expected)
+
+    # a server column that the entries were not measured on.
+    before = repository.state
+    append_log(path, [log_record("servers", names=["traefik"], fill=UNKNOWN)])
+    assert repository.refresh() == 1
+    assert repository.server_list[-1] == "traefik" and len(before.server_list) == 13
+    assert all(len(reaction) == 13 for reaction in before.entries)
+    expected = {reaction + (UNKNOWN,): entry for reaction, entry in expected.items()}
+    assert list(repository.entries) == list(expected)
+    check_queries(repository, expected)
+    for reaction in keys:
+        for value in (0, 1):
+            assert requests(repository.pick(reaction + (value,))) == \
+                requests(expected[reaction + (UNKNOWN,)]), reaction
+
+    # the same repository measured before the column was added, nothing new.
+    source = os.path.join(directory, "source.jsonl")
+    write_log(original, source)
+    assert append_repository(source, path) == 0
+    assert repository.refresh() == 0
+
+    # a source with new requests gets UNKNOWN on the added server.
+    write_log({first: [(7, original[second][0][1])]}, source)
+    assert append_repository(source, path) == 1
+    assert repository.refresh() == 1
+    assert requests(repository.pick(first + (0,)))[-1] == original[second][0][1].after_mut
+
+    # a re-measured entry is picked exactly, the unknown one for the other reaction.
+    append_log(path, entry_records(first + (1,), original[second][:1]))
+    assert repository.refresh() == 1
+    assert requests(repository.pick(first + (1,))) == requests(original[second][:1])
+    assert requests(repository.pick(first + (0,)))[0] == original[first][0][1].after_mut
+    expected[first + (1,)] = original[second][:1]
+    check_queries(repository, expected)
+
+    # a column added with a known reaction.
+    append_log(path, [log_record("servers", names=["pingora"], fill=0)])
+    assert repository.refresh() == 1
+    expected = {reaction + (0,): entry for reaction, entry in expected.items()}
+    check_queries(repository, expected)
+    assert repository.pick(first + (1, 1)) is False
+
+    # loading the log again gives what the refreshes built.
+    loaded = BehaviorRepository.load(path)
+    assert loaded.server_list == repository.server_list
+    assert list(loaded.entries) == list(repository.entries)
+    for reaction in loaded.entries:
+        assert requests(loaded.entries[reaction]) == requests(repository.entries[reaction])
+    assert query_keys(loaded) == query_keys(repository)
+
+
+def check_concurrent(directory, original):
+    """ pick and query from threads while the log is refreshed """
+
+    path = os.path.join(directory, "concurrent.jsonl")
+    write_log(original, path)
+    repository = BehaviorRepository.load(path)
+    keys = list(original)
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                width = len(repository.server_list)
+                repository.query([0], [1])
+                for reaction in keys:
+                    repository.pick(reaction + (0,) * (width - len(reaction)))
+                entries = repository.entries
+                for reaction in entries:
+                    entries[reaction]
+            except Exception as exception:
+                errors.append(exception)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for round_ in range(200):
+        fill = (UNKNOWN,) * (len(repository.server_list) - 13)
+        append_log(path, [log_record("drop", reaction=list(reaction + fill))
+                          for reaction in keys[:10]])
+        repository.refresh()
+        records = []
+        for reaction in keys[:10]:
+            records += entry_records(reaction + fill, original[reaction])
+        append_log(path, records)
+        repository.refresh()
+        if round_ % 50 == 25:
+            append_log(path, [log_record("servers", names=[f"server{round_}"], fill=UNKNOWN)])
+            repository.refresh()
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, f"{len(errors)} readers failed, e.g. {errors[0]!r}"
+    assert len(repository.entries) == len(original)
+    assert len(repository.server_list) == 13 + 4
+    return len(keys)
+
+
+def main():
+    original = read_pickle(REPOSITORY_PATH)
+    with tempfile.TemporaryDirectory() as directory:
+        check_log(directory, original)
+        keys = check_concurrent(directory, original)
+    print(f"the repository log matched after every refresh, {keys} keys picked concurrently")
+
+
+if __name__ == "__main__":
+    main()
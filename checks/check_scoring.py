@@ -0,0 +1,97 @@
+"""
+    offline check of read_response against results frozen from the simphile
+    based read_response of the original release. Every reference response of
+    the repository and a few variants of it are read against every entry, and
+    the matched servers of an entry are compared through their sha256. The
+    scores of the first response of every entry are compared exactly.
+    Run from the repository root: python checks/check_scoring.py
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import get_repository
+from scoring import featurize_references, score_servers, vectorized_available, VectorScorer
+from untangle import read_response
+
+FROZEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "frozen_scores.json")
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               "behavior_repository.out")
+
+
+def reference_responses(repository):
+    """ the reference responses of the probed entry of every key, in the repository order """
+
+    return [resp.responses for value in repository.entries.values() for _, resp in value[:1]]
+
+
+def live_responses(references):
+    """ the reference responses as live ones, with header, truncated and empty body variants """
+
+    lives = []
+    for responses in references:
+        for text in responses.values():
+            response = text.encode()
+            response = response[response.find(b'HTTP'):]
+            lives.append(response)
+            lives.append(response.replace(b'\r\n\r\n', b'\r\nX-Served-By: a\r\nCF-RAY: 1\r\n\r\n', 1))
+            lives.append(response[:len(response) // 2])
+            lives.append(response.split(b'\r\n\r\n')[0] + b'\r\n\r\n\n')
+    lives += [b'HTTP/1.1', b'HTTP/1.1 200 OK\r\n\r\n', b'', b' \r\n\r\n ']
+    return lives
+
+
+def outcome(function, *args):
+    """ the result of a call, or the name of the exception it raised """
+
+    try:
+        return function(*args)
+    except Exception as exception:
+        return "exception " + type(exception).__name__
+
+
+def digest(results):
+    """ sha256 of the matched servers of an entry """
+
+    return hashlib.sha256("\n".join(results).encode()).hexdigest()
+
+
+def main():
+    with open(FROZEN_PATH) as reader:
+        frozen = json.load(reader)
+
+    references = reference_responses(get_repository(REPOSITORY_PATH))
+    lives = live_responses(references)
+    assert len(references) == len(frozen["results"]), "the repository does not match the frozen results"
+
+    pairs = 0
+    for index, responses in enumerate(references):
+        features = featurize_references(responses)
+        results = [outcome(read_response, live, features) for live in lives]
+        assert digest(results) == frozen["results"][index], "read_response differs for entry %d" % index
+        assert [outcome(read_response, live, responses) for live in lives] == results, \
+            "raw and preprocessed references differ for entry %d" % index
+        pairs += len(lives)
+
+        first = next(iter(responses.values())).encode()
+        first = first[first.find(b'HTTP'):]
+        scores = score_servers(first, features)
+        assert scores == frozen["scores"][index], "scores differ for entry %d" % index
+
+        if vectorized_available():
+            batch = VectorScorer(features).score_batch(lives)
+            for live, scored in zip(lives, batch):
+                expected = outcome(score_servers, live, features)
+                if isinstance(scored, Exception):
+                    scored = "exception " + type(scored).__name__
+                assert scored == expected, "vectorized scores differ for entry %d" % index
+
+    print("read_response matches the frozen results on %d pairs" % pairs)
+
+
+if __name__ == "__main__":
+    main()
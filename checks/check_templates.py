@@ -0,0 +1,71 @@
+"""
+    offline check that RequestTemplate.render returns the same bytes as
+    build_request, or raises the same exception, for the requests of the
+    repository and for seeded random requests, targets and paths.
+    Run from the repository root: python checks/check_templates.py [seed]
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import get_repository
+from transport import build_request, RequestTemplate
+
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               "behavior_repository.out")
+
+TARGETS = ["www.example.com", b"a.b", "hostname.org", "x\\1y", "a\r\nb", "xn--eckwd4c7c.jp"]
+PATHS = [b"/", b"", "/a/b/", b"/hostname/", b"/x\r\ny", b"/host", b"name", b"/a b", b"\\g<0>"]
+# request fragments that hit the request line, the placeholder and the CRLF handling.
+ALPHABET = [b"hostname", b" ", b"\r\n", b"/", b"\r", b"\n", b"host", b"name", b"a", b"\\", b"GET",
+            b"HTTP/1.1"]
+FUZZED = 3000
+
+
+def outcome(function, *args):
+    """ the result of a call, or the type of the exception it raised """
+
+    try:
+        return function(*args)
+    except Exception as exception:
+        return type(exception)
+
+
+def fuzz(rng, count):
+    """ random joins of the alphabet """
+
+    return [b"".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, count)))
+            for _ in range(FUZZED)]
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    rng = random.Random(seed)
+
+    repository = get_repository(REPOSITORY_PATH)
+    requests = [resp.after_mut.encode() for value in repository.entries.values() for _, resp in value]
+    requests += fuzz(rng, 12)
+
+    targets = TARGETS + [b"".join(rng.choice(ALPHABET) for _ in range(3)) for _ in range(4)]
+    paths = PATHS + fuzz(rng, 4)[:8]
+
+    renders = 0
+    for request in requests:
+        template = RequestTemplate(request)
+        for target in targets:
+            for path in paths:
+                for from_redirection in (False, True):
+                    expected = outcome(build_request, target, path, request, from_redirection)
+                    rendered = outcome(template.render, target, path, from_redirection)
+                    assert rendered == expected, "%r %r %r %s: %r != %r" % (
+                        request, target, path, from_redirection, rendered, expected)
+                    renders += 1
+
+    print("%d templates rendered like build_request (seed %d)" % (renders, seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
 """ helper file """
 
-SERVER_N = 13
+import sys
+
+# The server columns of the reaction vectors, in order. A repository log can
+# add columns after these, see repository.py.
+SERVER_LIST = ["cloudfront", "cloudflare", "fastly", "akamai", "nginx", "varnish", "haproxy",
+               "apache", "caddy", "envoy", "ats", "squid", "tomcat"]
+SERVER_N = len(SERVER_LIST)
 
 class MyResponse:
     """ my response class """
@@ -21,3 +27,27 @@ class MyResponse:
         self.responses = {}
 
         self.server_reaction_list = [None]*SERVER_N
+
+
+class ProbeRecord:
+    """
+        Compact, slotted form of MyResponse that the scans keep in memory. It
+        keeps only the parts that the probes use, which every repository format
+        stores, so the record is the same whichever file it was loaded from.
+        The reaction vector is only kept as the repository key, so a record
+        does not change when server columns are added. The reference responses
+        are interned, so identical responses of different entries are stored
+        once. features and template are filled lazily by the scoring and the
+        transport.
+    """
+    __slots__ = ("after_mut", "responses", "features", "template")
+
+    def __init__(self, after_mut, responses):
+        self.after_mut = after_mut
+        self.responses = {sys.intern(name): sys.intern(text) for name, text in responses.items()}
+
+    @classmethod
+    def from_response(cls, resp):
+        """ converts a MyResponse, e.g. an unpickled one """
+
+        return cls(resp.after_mut, resp.responses)
@@ -0,0 +1,237 @@
+""" timings, counters and diagnostics of the scans, sent to pluggable sinks """
+
+import json
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds of the histogram buckets, the last bucket has no bound.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class JSONLinesSink():
+    """ writes every record as a JSON line, e.g. to a file that is analyzed later """
+    def __init__(self, output):
+        self.output = output
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, value, labels):
+        """ writes a record """
+
+        line = {"time": round(time.time(), 6), "kind": kind, "name": name, "value": value}
+        line.update(labels)
+        data = json.dumps(line, default=str) + "\n"
+        with self.lock:
+            self.output.write(data)
+            self.output.flush()
+
+
+class Histogram():
+    """ count, sum, min, max and bucket counts of the observed values """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, value):
+        """ adds a value """
+
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+
+    def merge(self, other):
+        """ adds the values of another histogram """
+
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+
+    def quantile(self, fraction):
+        """ upper bound of the bucket holding the quantile, max for the last bucket """
+
+        rank = fraction * self.count
+        seen = 0
+        for position, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if position < len(BUCKETS):
+                    return min(BUCKETS[position], self.max)
+                return self.max
+        return 0.0
+
+
+class Registry():
+    """ in-process counters and histograms, keyed by name and labels """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, sorted labels) -> int
+        self.counters = {}
+        # (name, sorted labels) -> Histogram
+        self.histograms = {}
+
+    def record(self, kind, name, value, labels):
+        """ adds a record to its counter or histogram """
+
+        if kind == "event":
+            # the fields of an event, e.g. the error message, are too diverse for labels.
+            kind, key = "counter", ("events", (("name", name),))
+        else:
+            key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            if kind == "counter":
+                self.counters[key] = self.counters.get(key, 0) + value
+            elif kind == "timing":
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram()
+                    self.histograms[key] = histogram
+                histogram.add(value)
+
+    def snapshot(self):
+        """ copies of the counters and histograms, e.g. to merge them in another process """
+
+        with self.lock:
+            return dict(self.counters), dict(self.histograms)
+
+    def merge(self, snapshot):
+        """ adds the counters and histograms of a snapshot """
+
+        counters, histograms = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram()
+                    self.histograms[key] = histogram
+                histogram.merge(other)
+
+    def counter(self, name, **labels):
+        """ returns the value of a counter """
+
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        """ returns a histogram, None if nothing was observed """
+
+        with self.lock:
+            return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def summary(self):
+        """ human readable lines, one per counter and histogram """
+
+        def label(name, labels):
+            if not labels:
+                return name
+            return name + "{" + ",".join(f"{key}={value}" for key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{label(name, labels)}: {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append(f"{label(name, labels)}: n={histogram.count} "
+                             f"mean={histogram.total / histogram.count * 1000:.1f}ms "
+                             f"p50<={histogram.quantile(0.5) * 1000:.1f}ms "
+                             f"p99<={histogram.quantile(0.99) * 1000:.1f}ms "
+                             f"max={histogram.max * 1000:.1f}ms")
+        return lines
+
+
+class _Timer():
+    """ context manager that observes the time spent in its block if it does not raise """
+    __slots__ = ("instrumentation", "name", "labels", "start")
+
+    def __init__(self, instrumentation, name, labels):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # failures are recorded as events, they would skew the timings.
+        if exc_type is None:
+            self.instrumentation.observe(self.name, time.perf_counter() - self.start,
+                                         **self.labels)
+
+
+class _NullTimer():
+    """ timer used when there is no sink """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation():
+    """
+        Records timings (seconds), counters and diagnostic events to the sinks.
+        Without sinks every call returns right away, so the probes do not pay
+        for instrumentation that nobody reads.
+    """
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def _record(self, kind, name, value, labels):
+        for sink in self.sinks:
+            sink.record(kind, name, value, labels)
+
+    def count(self, name, value=1, **labels):
+        """ increments a counter """
+
+        if self.sinks:
+            self._record("counter", name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        """ records a timing """
+
+        if self.sinks:
+            self._record("timing", name, seconds, labels)
+
+    def timer(self, name, **labels):
+        """ context manager that records the time spent in its block """
+
+        if self.sinks:
+            return _Timer(self, name, labels)
+        return _NULL_TIMER
+
+    def event(self, name, **fields):
+        """ records a diagnostic, e.g. an exception that a probe swallowed """
+
+        if self.sinks:
+            self._record("event", name, 1, fields)
+
+
+_DEFAULT_INSTRUMENTATION = Instrumentation()
+
+def get_instrumentation():
+    """ returns the instrumentation of the process, without sinks unless set """
+
+    return _DEFAULT_INSTRUMENTATION
+
+def set_instrumentation(instrumentation):
+    """ replaces the instrumentation of the process """
+
+    global _DEFAULT_INSTRUMENTATION
+    _DEFAULT_INSTRUMENTATION = instrumentation
@@ -0,0 +1,180 @@
+""" local TLS server that emulates a chain of servers from the behavior repository """
+
+import os
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import configargparse
+from repository import get_repository
+from transport import USER_AGENT, redirect_check_request
+
+HOSTNAME = "localhost"
+# The client sends a whole request at once, a request that does not match any
+# repository request is answered once it has been idle for this long.
+IDLE_TIMEOUT = 0.2
+
+FRONT_PAGE = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+# What send_request_and_fingerprint reads as "every layer forwarded the request".
+FORWARDED = b"HTTP/1.1 200"
+NOT_FOUND = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+def make_certificate(directory):
+    """ creates a self-signed certificate with openssl, returns the cert and key paths """
+
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-keyout", key, "-out", cert, "-days", "1", "-subj", f"/CN={HOSTNAME}"],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def reference_response(text):
+    """ strips the server-name line the repository puts in front of a reference response """
+
+    response = text.encode()
+    return response[response.find(b"HTTP"):]
+
+
+class ChainEmulator():
+    """ answers the repository requests like a chain of servers, the first one facing the client """
+    def __init__(self, chain, repository, hostname=HOSTNAME):
+        self.chain = [repository.server_list.index(server) for server in chain]
+        self.server_list = repository.server_list
+        self.hostname = hostname.encode()
+        self.front_page_request = redirect_check_request(hostname, "/", keep_alive=True)
+        # repository request bytes -> (reaction, reference responses)
+        self.requests = {}
+        entries = repository.entries
+        for reaction in entries:
+            for _, resp in entries[reaction]:
+                self.requests.setdefault(resp.after_mut.encode(), (reaction, resp.responses))
+
+    def normalize(self, data):
+        """ undoes what send_request adds to a repository request """
+
+        data = data.replace(b"\r\n" + USER_AGENT, b"", 1)
+        return data.replace(self.hostname, b"hostname")
+
+    def lookup(self, data):
+        """ returns the repository request matching the received bytes, if any """
+
+        return self.requests.get(self.normalize(data))
+
+    def respond(self, data):
+        """ returns the bytes the chain sends back for a request """
+
+        if data == self.front_page_request:
+            return FRONT_PAGE
+
+        match = self.lookup(data)
+        if match is None:
+            return NOT_FOUND
+
+        reaction, responses = match
+        for idx in self.chain:
+            if reaction[idx] == 1:
+                continue
+            if reaction[idx] != 0:
+                # too long, HTTP/0.9 or zero byte reactions, the connection is just closed.
+                return b""
+            text = responses.get(self.server_list[idx])
+            if text is None:
+                return NOT_FOUND
+            return reference_response(text)
+        return FORWARDED
+
+
+class MockServer():
+    """ TLS server on 127.0.0.1 that answers like a chain of servers """
+    def __init__(self, chain, repository, port=0):
+        self.emulator = ChainEmulator(chain, repository)
+        self.directory = tempfile.TemporaryDirectory()
+        cert, key = make_certificate(self.directory.name)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(cert, key)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+        mock = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            """ serves a single connection """
+            def handle(self):
+                mock.handle(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def handle(self, sock):
+        """ reads a request and answers it """
+
+        try:
+            with self.context.wrap_socket(sock, server_side=True) as ssock:
+                ssock.settimeout(IDLE_TIMEOUT)
+                data = b""
+                while (data != self.emulator.front_page_request
+                       and self.emulator.lookup(data) is None):
+                    try:
+                        chunk = ssock.recv(65536)
+                    except socket.timeout:
+                        break
+                    if not chunk:
+                        break
+                    data += chunk
+
+                with self.lock:
+                    self.requests += 1
+                response = self.emulator.respond(data)
+                if response:
+                    ssock.sendall(response)
+        except (OSError, ssl.SSLError):
+            pass
+
+    def start(self):
+        """ starts serving in a background thread """
+
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ stops serving and removes the certificate """
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    """ serves a chain until interrupted, e.g. python3 mockserver.py cloudflare nginx tomcat """
+
+    parser = configargparse.ArgParser(description='Mock multi-layer server stack.')
+    parser.add('chain', nargs="+", help="Servers of the chain, the first one faces the client.")
+    parser.add('-p', dest="port", type=int, default=8443, help="Port to listen on.")
+    parser.add('-r', dest="repository", type=str, help="Behavior repository to replay.")
+    args = parser.parse_args()
+
+    with MockServer(args.chain, get_repository(args.repository), args.port) as mock:
+        print(f"Serving {' -> '.join(args.chain)} on {HOSTNAME}:{mock.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+""" adaptive probe selection for Phase 2 and early stopping of Phase 2 and Phase 3 """
+
+import math
+from repository import reaction_masks, indexes_to_mask
+
+# Evidence of a probe matched with a scoring margin of 1 over the runner-up server.
+EVIDENCE_SCALE = 4
+# Evidence of a probe matched with no margin, the response still named the server.
+MIN_EVIDENCE = 1
+# A single probe cannot settle a layer on its own.
+MAX_EVIDENCE = 6
+# Evidence of a probe that no server was matched to.
+MISS_EVIDENCE = 1
+
+
+class ProbePlanner():
+    """
+        Picks the Phase 2 probes one by one from the reaction vectors. The next
+        layer is one of the candidate servers. A probe tells apart every
+        candidate that returns an error (its own response identifies it) from
+        the candidates that forward it. So the planner sends the probe whose
+        split has the highest entropy, narrows the candidates with the
+        prediction, and stops once a single observed candidate remains. When
+        no probe can split or confirm the candidates anymore, the caller falls
+        back to the exhaustive scan of the remaining probes.
+    """
+    def __init__(self, probes, candidates, server_list):
+        # (reaction, entry, forward mask, error mask) in the repository order.
+        self.remaining = []
+        for reaction, entry in probes:
+            forward_mask, error_mask = reaction_masks(reaction)
+            self.remaining.append((reaction, entry, forward_mask, error_mask))
+
+        self.eligible = len(self.remaining)
+        self.sent = 0
+        # A candidate that no probe can name cannot be told apart by Phase 2 either.
+        nameable = 0
+        for _, _, _, error_mask in self.remaining:
+            nameable |= error_mask
+        self.candidates = indexes_to_mask(candidates) & nameable
+        self.server_index = {name: idx for idx, name in enumerate(server_list)}
+        self.server_list = server_list
+        self.observed = 0
+
+    def _gain(self, forward_mask, error_mask):
+        """ entropy of the candidate split made by a probe """
+
+        total = bin(self.candidates).count("1")
+        errors = bin(self.candidates & error_mask).count("1")
+        forwards = bin(self.candidates & forward_mask).count("1")
+        if errors == 0:
+            return 0.0
+        if total == 1:
+            # A last candidate that was never observed still needs a probe that names it.
+            return 0.0 if self.candidates & self.observed else 1.0
+
+        gain = errors / total * math.log2(total)
+        if forwards:
+            gain += forwards / total * math.log2(total / forwards)
+        return gain
+
+    def next_probe(self):
+        """ removes and returns the most informative probe, None when no probe helps """
+
+        best = None
+        best_gain = 0.0
+        for position, (_, _, forward_mask, error_mask) in enumerate(self.remaining):
+            gain = self._gain(forward_mask, error_mask)
+            if gain > best_gain:
+                best = position
+                best_gain = gain
+
+        if best is None:
+            return None
+
+        self.sent += 1
+        reaction, entry, _, _ = self.remaining.pop(best)
+        return reaction, entry
+
+    def take_remaining(self):
+        """ removes and returns the probes that were not sent, for the exhaustive fallback """
+
+        remaining = [(reaction, entry) for reaction, entry, _, _ in self.remaining]
+        self.sent += len(remaining)
+        self.remaining = []
+        return remaining
+
+    def observe(self, reaction, predicted_server):
+        """ narrows the candidates with the prediction of a probe """
+
+        forward_mask, error_mask = reaction_masks(reaction)
+        idx = self.server_index.get(predicted_server)
+
+        if idx is not None:
+            if error_mask & (1 << idx):
+                # Either the next layer is the predicted server, or it forwarded the probe.
+                self.candidates &= (1 << idx) | forward_mask
+                self.observed |= 1 << idx
+        elif predicted_server in ("unknown", "200"):
+            # A candidate that returns an error would have been recognized.
+            self.candidates &= forward_mask
+
+    def next_layer(self):
+        """ the next layer when a single observed candidate remains, else None """
+
+        if self.candidates and self.candidates & (self.candidates - 1) == 0:
+            if self.candidates & self.observed:
+                return self.server_list[self.candidates.bit_length() - 1]
+        return None
+
+    def done(self):
+        """ whether probing more cannot change the outcome """
+
+        return self.candidates == 0 or self.next_layer() is not None
+
+    @property
+    def saved(self):
+        """ probes saved compared to the exhaustive scan """
+
+        return self.eligible - self.sent
+
+
+class LayerEvidence():
+    """
+        Sequential evidence about which candidate server is the next layer. A
+        probe answered by a server counts against the other candidates that
+        return an error on it, since their own response would have come back
+        instead, the more so the larger the scoring margin of the answer. The
+        candidates that forward the probe are not affected, the answer may come
+        from a server behind them. The confidence of a candidate is its softmax
+        share of the evidence, and only a candidate that answered a probe can
+        settle the layer.
+    """
+    def __init__(self, candidates, server_list, reactions=None):
+        if reactions is not None:
+            # A candidate that no probe can name cannot be told apart by the probes.
+            nameable = 0
+            for reaction in reactions:
+                nameable |= reaction_masks(reaction)[1]
+            candidates = [idx for idx in candidates if nameable & (1 << idx)]
+
+        self.server_index = {name: idx for idx, name in enumerate(server_list)}
+        self.server_list = server_list
+        # candidate index -> evidence, 0 or less
+        self.evidence = {idx: 0.0 for idx in candidates}
+        self.observed = 0
+
+    def observe(self, reaction, predicted_server, margin):
+        """ adds the prediction of a probe and the scoring margin of the prediction """
+
+        _, error_mask = reaction_masks(reaction)
+        idx = self.server_index.get(predicted_server)
+
+        if idx is not None:
+            weight = min(MAX_EVIDENCE, MIN_EVIDENCE + EVIDENCE_SCALE * margin)
+            if idx in self.evidence:
+                self.observed |= 1 << idx
+        elif predicted_server in ("unknown", "200"):
+            # A candidate that returns an error would have been recognized.
+            weight = MISS_EVIDENCE
+        else:
+            # timeouts, failures and empty responses say nothing.
+            return
+
+        for candidate in self.evidence:
+            if candidate != idx and error_mask & (1 << candidate):
+                self.evidence[candidate] -= weight
+
+    def confidence(self, predicted_server):
+        """ share of the evidence of a server, None if it is not a candidate """
+
+        idx = self.server_index.get(predicted_server)
+        if idx not in self.evidence:
+            return None
+        top = max(self.evidence.values())
+        total = sum(math.exp(value - top) for value in self.evidence.values())
+        return math.exp(self.evidence[idx] - top) / total
+
+    def leader(self):
+        """ the observed candidate with the most evidence and its confidence, or (None, 0) """
+
+        observed = [idx for idx in self.evidence if self.observed & (1 << idx)]
+        if not observed:
+            return None, 0.0
+        idx = max(observed, key=lambda candidate: self.evidence[candidate])
+        server = self.server_list[idx]
+        return server, self.confidence(server)
+
+    def settled(self, threshold):
+        """ whether the leader reached the confidence threshold, never for a threshold of 0 """
+
+        return bool(threshold) and self.leader()[1] >= threshold
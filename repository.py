@@ -0,0 +1,576 @@
+""" behavior repository """
+
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+from collections.abc import Mapping
+import configargparse
+from helper import ProbeRecord, SERVER_LIST
+
+PICKLE_PATH = "behavior_repository.out"
+BINARY_PATH = "behavior_repository.bin"
+LOG_PATH = "behavior_repository.jsonl"
+
+# Binary format:
+#   header: magic, version, number of servers, number of keys, then the server names
+#   index:  per key, the reaction vector, the record offset and the record length
+#   record: JSON list of [index, {"after_mut": ..., "responses": {...}}] per key
+MAGIC = b"UNTGLREP"
+VERSION = 1
+HEADER = struct.Struct("<8sHHI")
+INDEX_ENTRY = struct.Struct("<QI")
+
+# Log format: one JSON record per line, applied in order.
+#   {"op": "schema", "version": 1}                        first line
+#   {"op": "servers", "names": [...], "fill": -1}         adds server columns; the
+#       reaction vectors already in the log get fill for them
+#   {"op": "entry", "reaction": [...], "idx": 0, "after_mut": ..., "responses": {...}}
+#       appends an entry to the list of its reaction vector
+#   {"op": "drop", "reaction": [...]}                     removes a reaction vector
+LOG_VERSION = 1
+
+# Reactions other than error (0) and forward (1) are excluded from Phase 2 and Phase 3.
+ERROR = 0
+FORWARD = 1
+# Reaction of an entry on a server column added after it was measured. The
+# probes treat it as either reaction, so the entry is matched on its other servers.
+UNKNOWN = -1
+# Seconds between two checks of a repository log for appended records.
+REFRESH_INTERVAL = 30
+
+
+def reaction_masks(reaction):
+    """ returns the forward and error bitmasks of a reaction vector """
+
+    forward_mask = 0
+    error_mask = 0
+    for idx, value in enumerate(reaction):
+        if value == FORWARD:
+            forward_mask |= 1 << idx
+        elif value == ERROR:
+            error_mask |= 1 << idx
+    return forward_mask, error_mask
+
+
+def indexes_to_mask(indexes):
+    """ converts a list of server indexes to a bitmask """
+
+    mask = 0
+    for idx in indexes:
+        mask |= 1 << idx
+    return mask
+
+
+def encode_entry(entry):
+    """ encodes the part of an entry list that the probes use """
+
+    return json.dumps([[idx, {"after_mut": resp.after_mut, "responses": resp.responses}]
+                       for idx, resp in entry]).encode()
+
+
+def probe_response(after_mut, responses):
+    """ builds the compact record of an entry from the parts that the probes use """
+
+    return ProbeRecord(after_mut, responses)
+
+
+def decode_entry(data):
+    """ decodes an encoded entry list """
+
+    return [(idx, probe_response(fields["after_mut"], fields["responses"]))
+            for idx, fields in json.loads(data)]
+
+
+class MappedRecords(Mapping):
+    """ reaction tuple -> entry list, records are decoded from the mmap on first access """
+    def __init__(self, buffer, index):
+        self.buffer = buffer
+        # reaction tuple -> (offset, length), in the file order.
+        self.index = index
+        self.decoded = {}
+
+    def __getitem__(self, reaction):
+        entry = self.decoded.get(reaction)
+        if entry is None:
+            offset, length = self.index[reaction]
+            entry = decode_entry(self.buffer[offset:offset + length])
+            self.decoded[reaction] = entry
+        return entry
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def write_binary(entries, path, server_list=None):
+    """ writes reaction tuple -> entry list pairs in the binary format """
+
+    if server_list is None:
+        server_list = SERVER_LIST
+
+    names = b"".join(bytes([len(name)]) + name.encode() for name in server_list)
+    records = [(reaction, encode_entry(entry)) for reaction, entry in entries.items()]
+
+    offset = (HEADER.size + len(names) +
+              len(records) * (len(server_list) + INDEX_ENTRY.size))
+
+    with open(path, "wb") as writer:
+        writer.write(HEADER.pack(MAGIC, VERSION, len(server_list), len(records)))
+        writer.write(names)
+        for reaction, record in records:
+            writer.write(struct.pack(f"<{len(server_list)}b", *reaction))
+            writer.write(INDEX_ENTRY.pack(offset, len(record)))
+            offset += len(record)
+        for _, record in records:
+            writer.write(record)
+
+
+def read_binary(path):
+    """ maps a binary repository, returns the server list and the lazy records """
+
+    with open(path, "rb") as reader:
+        buffer = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, server_n, key_n = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} behavior repository")
+
+    position = HEADER.size
+    server_list = []
+    for _ in range(server_n):
+        length = buffer[position]
+        server_list.append(buffer[position + 1:position + 1 + length].decode())
+        position += 1 + length
+
+    reaction_format = struct.Struct(f"<{server_n}b")
+    index = {}
+    for _ in range(key_n):
+        reaction = reaction_format.unpack_from(buffer, position)
+        position += reaction_format.size
+        index[reaction] = INDEX_ENTRY.unpack_from(buffer, position)
+        position += INDEX_ENTRY.size
+
+    return server_list, MappedRecords(buffer, index)
+
+
+def log_record(op, **fields):
+    """ encodes a log record as a line """
+
+    fields["op"] = op
+    return json.dumps(fields) + "\n"
+
+
+def entry_records(reaction, entry):
+    """ the log records of the entries of a reaction vector """
+
+    return [log_record("entry", reaction=list(reaction), idx=idx, after_mut=resp.after_mut,
+                       responses=resp.responses)
+            for idx, resp in entry]
+
+
+def write_log(entries, path, server_list=None):
+    """ writes reaction tuple -> entry list pairs as a new repository log """
+
+    if server_list is None:
+        server_list = SERVER_LIST
+
+    with open(path, "w", encoding="utf-8") as writer:
+        writer.write(log_record("schema", version=LOG_VERSION))
+        writer.write(log_record("servers", names=list(server_list), fill=UNKNOWN))
+        for reaction, entry in entries.items():
+            writer.writelines(entry_records(reaction, entry))
+
+
+def append_log(path, records):
+    """
+        Appends records to a repository log in a single write, so a scanner
+        that refreshes the log never reads half of an append.
+    """
+
+    with open(path, "a", encoding="utf-8") as writer:
+        writer.write("".join(records))
+
+
+def read_pickle(path, compact=True):
+    """
+        Unpickles the repository, returns the entries keyed by reaction tuple.
+        The MyResponse objects are converted to compact ProbeRecords unless
+        compact is False.
+    """
+
+    with open(path, "rb") as reader:
+        hashmap = pickle.load(reader)
+
+    entries = {}
+    for key, value in hashmap.items():
+        reaction = tuple(json.loads(key))
+        if compact:
+            value = [(idx, ProbeRecord.from_response(resp)) for idx, resp in value]
+        entries[reaction] = value
+    return entries
+
+
+class RepositoryState():
+    """
+        The entries, the binary index and the server list of a repository. A
+        published state is never changed: the repository log builds the next
+        state off to the side and the repository replaces its state at once,
+        so a reader that takes a single reference to it sees them together.
+    """
+    __slots__ = ("entries", "binary_index", "partial_index", "server_list")
+
+    def __init__(self, entries, server_list, binary_index=None):
+        # reaction tuple -> entry list, in the repository order.
+        self.entries = entries
+        self.server_list = server_list
+        # (reaction tuple, forward mask, error mask, known mask) for the keys with only
+        # 0/1 reactions, and UNKNOWN ones on the servers added after they were measured.
+        self.binary_index = []
+        # known mask -> {(forward mask, error mask): reaction tuple} for the keys with
+        # UNKNOWN reactions, to pick them on their known servers.
+        self.partial_index = {}
+        if binary_index is None:
+            for reaction in entries:
+                self.index(reaction)
+        else:
+            self.reindex(binary_index)
+
+    def index(self, reaction):
+        """ adds a reaction vector to the binary index """
+
+        forward_mask, error_mask = reaction_masks(reaction)
+        known_mask = forward_mask | error_mask
+        unknown_mask = indexes_to_mask(idx for idx, value in enumerate(reaction)
+                                       if value == UNKNOWN)
+        if known_mask | unknown_mask != (1 << len(reaction)) - 1:
+            return
+        self.binary_index.append((reaction, forward_mask, error_mask, known_mask))
+        if unknown_mask:
+            self.partial_index.setdefault(known_mask, {}).setdefault(
+                (forward_mask, error_mask), reaction)
+
+    def reindex(self, binary_index):
+        """ replaces the binary index, e.g. without the dropped keys """
+
+        self.binary_index = []
+        self.partial_index = {}
+        for reaction, _, _, _ in binary_index:
+            self.index(reaction)
+
+    def copy(self):
+        """ a copy to build the next state from, the entry lists are shared """
+
+        return RepositoryState(dict(self.entries), list(self.server_list),
+                               list(self.binary_index))
+
+
+class BehaviorRepository():
+    """
+        Holds the behavior repository in memory. Every reaction vector is
+        indexed once with forward/error bitmasks.
+    """
+    def __init__(self, entries, server_list=None):
+        self.state = RepositoryState(entries, list(server_list) if server_list is not None
+                                     else list(SERVER_LIST))
+        # repository log that refresh() follows, and the offset read so far.
+        self.log_path = None
+        self.log_offset = 0
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def entries(self):
+        """ reaction tuple -> entry list of the current state """
+
+        return self.state.entries
+
+    @property
+    def server_list(self):
+        """ the server columns of the current state """
+
+        return self.state.server_list
+
+    @property
+    def binary_index(self):
+        """ the binary index of the current state """
+
+        return self.state.binary_index
+
+    @classmethod
+    def load(cls, path=None):
+        """ loads the repository from the disk, the format is detected from the file """
+
+        if path is None:
+            path = default_repository_path()
+
+        with open(path, "rb") as reader:
+            magic = reader.read(len(MAGIC))
+
+        if magic == MAGIC:
+            server_list, entries = read_binary(path)
+            return cls(entries, server_list)
+        if magic.startswith(b"{"):
+            repository = cls({}, [])
+            repository.log_path = path
+            repository.refresh()
+            return repository
+        return cls(read_pickle(path))
+
+    @staticmethod
+    def apply(record, state):
+        """ applies a log record to a state that is not published yet """
+
+        operation = record["op"]
+        if operation == "schema":
+            if record["version"] != LOG_VERSION:
+                raise ValueError(f"unsupported repository log version {record['version']}")
+
+        elif operation == "servers":
+            fill = (record.get("fill", UNKNOWN),) * len(record["names"])
+            # the entry lists and their records are shared with the published state.
+            entries = {reaction + fill: entry for reaction, entry in state.entries.items()}
+            state.entries = entries
+            state.server_list = state.server_list + record["names"]
+            state.reindex([(reaction, None, None, None) for reaction in entries])
+
+        elif operation == "entry":
+            reaction = tuple(record["reaction"])
+            if len(reaction) != len(state.server_list):
+                raise ValueError(f"reaction {reaction} does not have "
+                                 f"{len(state.server_list)} servers")
+            resp = probe_response(record["after_mut"], record["responses"])
+            entry = state.entries.get(reaction)
+            if entry is None:
+                state.entries[reaction] = [(record["idx"], resp)]
+                state.index(reaction)
+            else:
+                # the published state shares the entry list.
+                state.entries[reaction] = entry + [(record["idx"], resp)]
+
+        elif operation == "drop":
+            reaction = tuple(record["reaction"])
+            if state.entries.pop(reaction, None) is not None:
+                state.reindex([indexed for indexed in state.binary_index
+                               if indexed[0] != reaction])
+
+        else:
+            raise ValueError(f"unknown repository log record {operation}")
+
+    def refresh(self):
+        """
+            Applies the records appended to the repository log since the last
+            refresh to a new state and publishes it, so running scans pick up
+            new probes without a reload. Returns the number of records applied.
+        """
+
+        if self.log_path is None:
+            return 0
+
+        with self.lock:
+            self.checked = time.monotonic()
+            if os.path.getsize(self.log_path) <= self.log_offset:
+                return 0
+
+            with open(self.log_path, "rb") as reader:
+                reader.seek(self.log_offset)
+                data = reader.read()
+
+            # a line without its newline is still being written.
+            end = data.rfind(b"\n") + 1
+            records = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+            if not records:
+                return 0
+            state = self.state.copy()
+            for record in records:
+                self.apply(record, state)
+            # the scans see either the old state or the new one, never a mix.
+            self.state = state
+            self.log_offset += end
+            return len(records)
+
+    def refresh_if_due(self, interval=REFRESH_INTERVAL):
+        """ refreshes the repository log at most once per interval seconds """
+
+        if self.log_path is not None and time.monotonic() - self.checked >= interval:
+            return self.refresh()
+        return 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pick(self, server_reaction_list):
+        """
+            Returns the entry that has exactly the given reaction, else the
+            entry whose reaction matches it on every server it was measured
+            on, the most measured servers first, else False.
+        """
+
+        reaction = tuple(server_reaction_list)
+        state = self.state
+        if reaction in state.entries:
+            return state.entries[reaction]
+
+        forward_mask, error_mask = reaction_masks(reaction)
+        for known_mask in sorted(state.partial_index, key=lambda mask: -bin(mask).count("1")):
+            key = state.partial_index[known_mask].get((forward_mask & known_mask,
+                                                       error_mask & known_mask))
+            if key is not None and len(key) == len(reaction):
+                return state.entries[key]
+        return False
+
+    def query(self, forwarding=(), erroring=()):
+        """
+            Returns (reaction, entry) pairs whose reaction has only forward/error
+            reactions, where every server in forwarding forwards and every
+            server in erroring returns an error. An UNKNOWN reaction matches
+            both.
+        """
+
+        forward_mask = indexes_to_mask(forwarding)
+        error_mask = indexes_to_mask(erroring)
+        state = self.state
+
+        return [(reaction, state.entries[reaction])
+                for reaction, key_forward, key_error, key_known in state.binary_index
+                if key_forward & forward_mask == forward_mask & key_known
+                and key_error & error_mask == error_mask & key_known]
+
+
+def default_repository_path():
+    """ prefers the repository log, then the binary repository, when they have been converted """
+
+    for path in (LOG_PATH, BINARY_PATH):
+        if os.path.exists(path):
+            return path
+    return PICKLE_PATH
+
+
+_REPOSITORIES = {}
+
+def get_repository(path=None):
+    """ loads the repository once per process and returns the cached instance """
+
+    if path is None:
+        path = default_repository_path()
+
+    repository = _REPOSITORIES.get(path)
+    if repository is None:
+        repository = BehaviorRepository.load(path)
+        _REPOSITORIES[path] = repository
+    return repository
+
+
+def compact(entries):
+    """
+        Keeps the first entry of every reaction vector, the only one that
+        pick, Phase 2 and Phase 3 send. The others are alternative requests
+        with the same reaction vector. The keys and their order are kept, so
+        every scan sends the same probes with the compacted repository.
+    """
+
+    return {reaction: list(entry[:1]) for reaction, entry in entries.items()}
+
+
+def file_digest(path):
+    """ sha256 of a file, to check that a compaction is reproducible """
+
+    with open(path, "rb") as reader:
+        return hashlib.sha256(reader.read()).hexdigest()
+
+
+def convert(source, destination):
+    """ converts a pickled repository to the binary format """
+
+    entries = read_pickle(source)
+    write_binary(entries, destination)
+    return len(entries)
+
+
+def append_repository(source, destination):
+    """
+        Appends the entries of a repository to a repository log, skipping the
+        requests the log already has for the same reaction vector. A source
+        without the servers added last to the log gets UNKNOWN reactions on
+        them. Returns the number of appended entries.
+    """
+
+    log = BehaviorRepository.load(destination)
+    new = BehaviorRepository.load(source)
+    if new.server_list != log.server_list[:len(new.server_list)]:
+        raise ValueError(f"the servers of {source} are not the first servers of {destination}")
+    # the source was measured before the last servers were added to the log.
+    fill = (UNKNOWN,) * (len(log.server_list) - len(new.server_list))
+
+    records = []
+    for reaction, entry in new.entries.items():
+        reaction = reaction + fill
+        known = {resp.after_mut for _, resp in log.entries.get(reaction, [])}
+        records.extend(entry_records(reaction, [(idx, resp) for idx, resp in entry
+                                                if resp.after_mut not in known]))
+    append_log(destination, records)
+    return len(records)
+
+
+def main():
+    """ repository tools """
+
+    parser = configargparse.ArgParser(description='Behavior repository tools.')
+    parser.add('command', choices=["convert", "compact", "log", "append", "add-server"],
+               help="convert: converts a pickled repository to the binary format. "
+                    "compact: keeps only the probed entry of every reaction vector and "
+                    "writes the result in the binary format. "
+                    "log: writes a repository as a new append-only repository log. "
+                    "append: appends the new entries of the source repository to the "
+                    "destination log. "
+                    "add-server: adds the --name server column to the source log.")
+    parser.add('source', nargs="?", default=PICKLE_PATH, help="Repository to read.")
+    parser.add('destination', nargs="?", default=BINARY_PATH, help="Repository to write.")
+    parser.add('--name', dest="name", type=str, help="Server to add with add-server.")
+    parser.add('--fill', dest="fill", type=int, default=UNKNOWN,
+               help="Reaction of the existing entries on the added server, "
+                    f"{UNKNOWN} (unknown) matches them on the other servers only.")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        count = convert(args.source, args.destination)
+        print(f"Converted {count} keys from {args.source} to {args.destination}",
+              file=sys.stderr)
+    elif args.command == "compact":
+        repository = BehaviorRepository.load(args.source)
+        entries = dict(repository.entries.items())
+        compacted = compact(entries)
+        write_binary(compacted, args.destination, repository.server_list)
+        before = sum(len(entry) for entry in entries.values())
+        after = sum(len(entry) for entry in compacted.values())
+        print(f"Compacted {before} entries into {after} in {len(compacted)} keys, "
+              f"{args.destination} sha256 {file_digest(args.destination)}", file=sys.stderr)
+    elif args.command == "log":
+        repository = BehaviorRepository.load(args.source)
+        write_log(repository.entries, args.destination, repository.server_list)
+        print(f"Wrote {len(repository)} keys from {args.source} to {args.destination}",
+              file=sys.stderr)
+    elif args.command == "append":
+        try:
+            count = append_repository(args.source, args.destination)
+        except ValueError as exception:
+            parser.error(str(exception))
+        print(f"Appended {count} entries from {args.source} to {args.destination}",
+              file=sys.stderr)
+    elif args.command == "add-server":
+        if args.name is None:
+            parser.error("add-server requires --name")
+        if args.name in BehaviorRepository.load(args.source).server_list:
+            parser.error(f"{args.source} already has {args.name}")
+        append_log(args.source, [log_record("servers", names=[args.name], fill=args.fill)])
+        print(f"Added {args.name} to {args.source}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
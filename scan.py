@@ -0,0 +1,288 @@
+""" batch scanning of many targets """
+
+import gc
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from instrumentation import Registry, get_instrumentation
+
+
+def read_targets(source):
+    """ yields the targets in a file one by one, '-' reads stdin """
+
+    if source == "-":
+        reader = sys.stdin
+    else:
+        reader = open(source, "r", encoding="utf-8")
+
+    try:
+        for line in reader:
+            target = line.strip()
+            # skip empty lines and comments.
+            if target and not target.startswith("#"):
+                yield target
+    finally:
+        if reader is not sys.stdin:
+            reader.close()
+
+
+def resolve_ahead(targets, resolve_batch, window):
+    """
+        Yields the targets, calling resolve_batch on every window of them
+        before they are yielded, e.g. to resolve their redirects concurrently.
+    """
+
+    if window <= 0:
+        yield from targets
+        return
+
+    batch = []
+    for target in targets:
+        batch.append(target)
+        if len(batch) >= window:
+            resolve_batch(batch)
+            yield from batch
+            batch = []
+    if batch:
+        resolve_batch(batch)
+        yield from batch
+
+
+class HostLimiter():
+    """ caps the number of concurrent scans of the same host """
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        # host -> [semaphore, number of users]
+        self.semaphores = {}
+
+    def acquire(self, host):
+        """ blocks until the host has a free slot """
+
+        with self.lock:
+            slot = self.semaphores.setdefault(host, [threading.Semaphore(self.per_host), 0])
+            slot[1] += 1
+        slot[0].acquire()
+
+    def release(self, host):
+        """ frees the slot, forgets the host when nobody uses it """
+
+        with self.lock:
+            slot = self.semaphores[host]
+            slot[0].release()
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self.semaphores[host]
+
+
+def scan_target(fingerprint_fn, target, port, limiter):
+    """ fingerprints a single target and returns its result record """
+
+    host = target.lower()
+    limiter.acquire(host)
+    start = time.monotonic()
+    try:
+        layers = fingerprint_fn(target, port)
+        result = {"target": target}
+        # fingerprint_fn returns the layers, or a dict with the layers and more fields.
+        if isinstance(layers, dict):
+            result.update(layers)
+        else:
+            result["layers"] = layers
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        return result
+    except Exception as exception:
+        return {"target": target, "error": str(exception),
+                "elapsed": round(time.monotonic() - start, 3)}
+    finally:
+        limiter.release(host)
+
+
+def write_result(output, result):
+    """ writes a result as a JSON line """
+
+    output.write(json.dumps(result) + "\n")
+    output.flush()
+
+
+def scan_targets(targets, fingerprint_fn, output, workers=16, per_host=1, port=443):
+    """
+        Fingerprints the targets with a bounded thread pool and streams every
+        result to output as soon as it finishes. At most 2 * workers targets
+        are held in memory. Returns the throughput statistics.
+    """
+
+    limiter = HostLimiter(per_host)
+    max_pending = 2 * workers
+    pending = set()
+    scanned = 0
+    failed = 0
+    start = time.monotonic()
+
+    def collect(futures):
+        nonlocal scanned, failed
+        for future in futures:
+            result = future.result()
+            scanned += 1
+            if "error" in result:
+                failed += 1
+            write_result(output, result)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for target in targets:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(scan_target, fingerprint_fn, target, port, limiter))
+
+        done, _ = wait(pending)
+        collect(done)
+
+    elapsed = time.monotonic() - start
+    return {"scanned": scanned, "failed": failed, "elapsed": elapsed,
+            "hosts_per_sec": scanned / elapsed if elapsed > 0 else 0.0}
+
+
+class QueueOutput():
+    """ output of a scan process, sends the JSON lines to the parent """
+    def __init__(self, results):
+        self.results = results
+
+    def write(self, line):
+        """ sends a line """
+
+        self.results.put(("line", line))
+
+    def flush(self):
+        """ lines are sent as they are written """
+
+
+def registries():
+    """ the in-process registries that the instrumentation of the process feeds """
+
+    return [sink for sink in get_instrumentation().sinks if isinstance(sink, Registry)]
+
+
+def scan_shard(shard, tasks, results, make_fingerprint_fn, prepare_targets, accept_hint,
+               workers, per_host, port):
+    """ runs in a scan process, scans the targets of its task queue with a thread pool """
+
+    def targets():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            target, hint = task
+            if accept_hint is not None and hint is not None:
+                accept_hint(target, hint)
+            yield target
+
+    fingerprint_fn = make_fingerprint_fn()
+    shard_targets = targets()
+    if prepare_targets is not None:
+        shard_targets = prepare_targets(shard_targets)
+
+    stats = scan_targets(shard_targets, fingerprint_fn, QueueOutput(results),
+                         workers=workers, per_host=per_host, port=port)
+    results.put(("done", shard, stats, [registry.snapshot() for registry in registries()]))
+
+
+def shard_of(target, processes):
+    """ the process that scans a target, the same for every target of a host """
+
+    return zlib.crc32(target.lower().encode()) % processes
+
+
+def scan_targets_processes(targets, make_fingerprint_fn, output, processes, workers=16,
+                           per_host=1, port=443, prepare_targets=None, route=None,
+                           accept_hint=None):
+    """
+        Fingerprints the targets with several forked processes, each running
+        scan_targets with its own thread pool, so that scoring uses every core.
+        The processes share the memory of the parent copy-on-write, so the
+        repository and its features must be loaded and prepared before.
+        Targets are sharded by a hash of their host, so the limits of a host
+        hold across processes. route(target), if given, returns the host that
+        the target is really probed on, e.g. after its redirects, and a hint
+        that accept_hint(target, hint) receives in the scan process.
+        make_fingerprint_fn is called in every process to build its own
+        transport session and caches, then prepare_targets, if any, wraps the
+        targets of the process. The results are merged into output.
+        The statistics count the processes that crashed, their remaining
+        targets are not scanned.
+    """
+
+    context = multiprocessing.get_context("fork")
+    tasks = [context.Queue(maxsize=2 * workers) for _ in range(processes)]
+    results = context.Queue()
+    start = time.monotonic()
+
+    # keep the objects loaded so far out of the garbage collector, whose
+    # bookkeeping would otherwise copy their pages in every process.
+    gc.freeze()
+    children = [context.Process(target=scan_shard,
+                                args=(shard, tasks[shard], results, make_fingerprint_fn,
+                                      prepare_targets, accept_hint, workers, per_host, port),
+                                daemon=True)
+                for shard in range(processes)]
+    for child in children:
+        child.start()
+
+    def put(shard, task):
+        # a process that died does not read its queue anymore.
+        while children[shard].is_alive():
+            try:
+                tasks[shard].put(task, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def feed():
+        for target in targets:
+            host, hint = route(target) if route is not None else (target, None)
+            put(shard_of(host, processes), (target, hint))
+        for shard in range(processes):
+            put(shard, None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    scanned = 0
+    failed = 0
+    crashed = 0
+    running = set(range(processes))
+    while running:
+        try:
+            message = results.get(timeout=1)
+        except queue.Empty:
+            # a process that died before reporting is not waited for.
+            alive = {shard for shard in running
+                     if children[shard].is_alive() or children[shard].exitcode == 0}
+            crashed += len(running - alive)
+            running = alive
+            continue
+
+        if message[0] == "line":
+            output.write(message[1])
+            output.flush()
+        else:
+            _, shard, stats, snapshots = message
+            running.discard(shard)
+            scanned += stats["scanned"]
+            failed += stats["failed"]
+            for registry in registries():
+                for snapshot in snapshots:
+                    registry.merge(snapshot)
+
+    for child in children:
+        child.join()
+    gc.unfreeze()
+
+    elapsed = time.monotonic() - start
+    return {"scanned": scanned, "failed": failed, "crashed": crashed, "elapsed": elapsed,
+            "hosts_per_sec": scanned / elapsed if elapsed > 0 else 0.0}
@@ -0,0 +1,250 @@
+""" probe scheduling: concurrency, per-host rate limits, deadlines and retries """
+
+import asyncio
+import random
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 10
+# Adaptive timeouts never go below these, a slow response must not look like a hang.
+MIN_CONNECT_TIMEOUT = 1
+MIN_READ_TIMEOUT = 2
+# Adaptive timeout = multiplier * (smoothed RTT + 4 * RTT variation), see RFC 6298.
+ADAPTIVE_MULTIPLIER = 2
+# RTT samples of a target needed before its timeouts adapt.
+ADAPTIVE_MIN_SAMPLES = 3
+RETRIES = 1
+RETRY_BACKOFF = 0.25
+MAX_RETRY_BACKOFF = 4
+# Host buckets are pruned once there are this many.
+MAX_BUCKETS = 4096
+
+# Connection failures worth another attempt. They happen before the probe is
+# sent, so a retry never changes how a server reacts to the probe.
+TRANSIENT_ERRORS = (ConnectionError, socket.timeout, ssl.SSLEOFError)
+
+
+class TokenBucket():
+    """ allows rate probes per second on average and bursts of up to burst probes """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate or 0
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """ takes a token, returns the seconds to wait before using it """
+
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # a negative balance reserves the next tokens, so the waiters are served in order.
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self):
+        """ blocks until a token is available and takes it """
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def idle(self, now):
+        """ whether the bucket is full again, so it can be dropped """
+
+        with self.lock:
+            return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class HostScheduler():
+    """ token bucket per host, shared by every scan of the process """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # host -> TokenBucket
+        self.buckets = {}
+
+    def reserve(self, host):
+        """ takes a token of the host, returns the seconds to wait before the probe """
+
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    now = time.monotonic()
+                    self.buckets = {key: value for key, value in self.buckets.items()
+                                    if not value.idle(now)}
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[host] = bucket
+        return bucket.reserve()
+
+    def wait(self, host):
+        """ blocks until a probe to the host is allowed """
+
+        wait = self.reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def wait_async(self, host):
+        """ asyncio version of wait """
+
+        wait = self.reserve(host)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class RttEstimator():
+    """ smoothed RTT and RTT variation of RFC 6298 """
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def add(self, sample):
+        """ adds an RTT sample in seconds """
+
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.samples += 1
+
+    def timeout(self):
+        """ retransmission timeout of the samples """
+
+        return self.srtt + 4 * self.rttvar
+
+
+class Deadlines():
+    """
+        Connect (TCP and TLS handshake) and read (whole response) deadlines.
+        When adaptive, they are learned per target from the handshake times and
+        the times to first byte, between the minimums and the configured values.
+    """
+    def __init__(self, connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, adaptive=False):
+        self.connect = connect
+        self.read = read
+        self.adaptive = adaptive
+        self.lock = threading.Lock()
+        # (host, port) -> RttEstimator
+        self.connect_rtts = {}
+        self.response_rtts = {}
+
+    def _timeout(self, rtts, key, minimum, maximum):
+        if not self.adaptive:
+            return maximum
+        with self.lock:
+            estimator = rtts.get(key)
+            if estimator is None or estimator.samples < ADAPTIVE_MIN_SAMPLES:
+                return maximum
+            timeout = ADAPTIVE_MULTIPLIER * estimator.timeout()
+        return min(maximum, max(minimum, timeout))
+
+    def _observe(self, rtts, key, seconds):
+        if not self.adaptive:
+            return
+        with self.lock:
+            estimator = rtts.get(key)
+            if estimator is None:
+                estimator = RttEstimator()
+                rtts[key] = estimator
+            estimator.add(seconds)
+
+    def connect_timeout(self, key):
+        """ seconds allowed for the TCP connect and the TLS handshake of a target """
+
+        return self._timeout(self.connect_rtts, key, MIN_CONNECT_TIMEOUT, self.connect)
+
+    def read_timeout(self, key):
+        """ seconds allowed for sending the probe and reading the whole response """
+
+        return self._timeout(self.response_rtts, key, MIN_READ_TIMEOUT, self.read)
+
+    def observe_connect(self, key, seconds):
+        """ adds the time of a TCP connect and TLS handshake """
+
+        self._observe(self.connect_rtts, key, seconds)
+
+    def observe_response(self, key, seconds):
+        """ adds a time to first byte """
+
+        self._observe(self.response_rtts, key, seconds)
+
+
+class RetryPolicy():
+    """ retries transient connection failures with exponential backoff and full jitter """
+    def __init__(self, retries=RETRIES, backoff=RETRY_BACKOFF, max_backoff=MAX_RETRY_BACKOFF):
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        """ seconds to wait before the retry after the given failed attempt """
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, attempt_fn, on_retry=None):
+        """ returns the result of attempt_fn, calling it again on transient failures """
+
+        attempt = 0
+        while True:
+            try:
+                return attempt_fn()
+            except TRANSIENT_ERRORS as exception:
+                if attempt >= self.retries:
+                    raise
+                if on_retry is not None:
+                    on_retry(exception)
+                time.sleep(self.delay(attempt))
+                attempt += 1
+
+    async def call_async(self, attempt_fn, on_retry=None):
+        """ asyncio version of call, attempt_fn returns a coroutine """
+
+        attempt = 0
+        while True:
+            try:
+                return await attempt_fn()
+            except TRANSIENT_ERRORS + (asyncio.TimeoutError,) as exception:
+                if attempt >= self.retries:
+                    raise
+                if on_retry is not None:
+                    on_retry(exception)
+                await asyncio.sleep(self.delay(attempt))
+                attempt += 1
+
+
+class ProbeDispatcher():
+    """
+        Sends the probes of a phase concurrently with a limit on in-flight
+        probes. The per-host rate limit is applied by the transport session.
+    """
+    def __init__(self, max_in_flight=8):
+        self.max_in_flight = max(1, max_in_flight)
+
+    def map(self, probe_fn, items):
+        """ runs probe_fn on every item and returns the results in the item order """
+
+        items = list(items)
+
+        if self.max_in_flight == 1 or len(items) <= 1:
+            return [probe_fn(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(items))) as executor:
+            futures = [executor.submit(probe_fn, item) for item in items]
+            return [future.result() for future in futures]
@@ -0,0 +1,304 @@
+""" response scoring against the reference responses of the repository """
+
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Minimum score for a response to be matched to a server.
+THRESHOLD = 1.8222222222222224
+
+# Servers that get +1 when one of their headers is in the response, -1 otherwise.
+FINGERPRINT_HEADERS = {
+    "fastly": (b"x-served-by:",),
+    "cloudfront": (b"x-amz-cf-pop:", b"x-amz-cf-id"),
+    "cloudflare": (b"cf-cache-status:", b"cf-ray"),
+}
+
+
+def tokenize(text):
+    """ returns the whitespace separated tokens of a text as a multiset and its size """
+
+    tokens = text.split()
+    return Counter(tokens), len(tokens)
+
+
+def jaccard(tokens_a, size_a, tokens_b, size_b):
+    """ Jaccard similarity of two token multisets, same as simphile.jaccard_similarity """
+
+    assert (size_a > 0 or size_b > 0), "at least one list needs to have elements"
+
+    if len(tokens_a) > len(tokens_b):
+        tokens_a, tokens_b = tokens_b, tokens_a
+
+    intersection = 0
+    for token, count in tokens_a.items():
+        other = tokens_b.get(token)
+        if other:
+            intersection += count if count < other else other
+
+    return intersection / (size_a + size_b - intersection)
+
+
+class ReferenceFeatures():
+    """ the parts of a reference response that read_response compares """
+    __slots__ = ("code", "tokens", "body_length", "body", "headers", "error")
+
+    def __init__(self, text):
+        self.error = None
+        self.headers = ()
+        try:
+            comp = text.encode()
+            self.code = tokenize(comp[comp.find(b'HTTP'):].split(b'\r\n')[0].split(b" ")[1].lower())
+            comp = comp.lower()
+            self.tokens = tokenize(comp)
+            body = comp.split(b'\r\n\r\n')[1]
+            self.body_length = len(body)
+            self.body = tokenize(body)
+        except Exception as exception:
+            # raised when the server is scored, as read_response used to.
+            self.error = exception
+
+
+class ResponseFeatures():
+    """ the parts of a live response that read_response compares """
+    __slots__ = ("code", "tokens", "body_length", "body", "lowered")
+
+    def __init__(self, response):
+        self.code = tokenize(response.split(b'\r\n')[0].split(b" ")[1].lower())
+        self.lowered = response.lower()
+        self.tokens = tokenize(self.lowered)
+        body = self.lowered.split(b'\r\n\r\n')[1]
+        self.body_length = len(body)
+        self.body = tokenize(body)
+
+
+def featurize_references(original_responses):
+    """ preprocesses the reference responses of an entry, keeps the server order """
+
+    features = {}
+    for server_name, text in original_responses.items():
+        reference = ReferenceFeatures(text)
+        reference.headers = FINGERPRINT_HEADERS.get(server_name, ())
+        features[server_name] = reference
+    return features
+
+
+def reference_features(resp):
+    """ returns the preprocessed reference responses of an entry, computed once """
+
+    features = getattr(resp, "features", None)
+    if features is None:
+        features = featurize_references(resp.responses)
+        resp.features = features
+    return features
+
+
+def as_features(original_responses):
+    """ accepts raw or preprocessed reference responses """
+
+    for value in original_responses.values():
+        if isinstance(value, ReferenceFeatures):
+            return original_responses
+        break
+    return featurize_references(original_responses)
+
+
+def score_servers(response, features):
+    """ returns the similarity score of the response for every reference server """
+
+    scores = {}
+    if not features:
+        return scores
+
+    live = ResponseFeatures(response)
+
+    for server_name, reference in features.items():
+        if reference.error is not None:
+            raise reference.error
+
+        response_code_sim = jaccard(*reference.code, *live.code)
+        jaccard_request_sim = jaccard(*reference.tokens, *live.tokens)
+
+        response_body_sim = 0
+        if live.body_length <= 1 and reference.body_length == 0:
+            response_body_sim = 1
+        elif live.body_length != 0 and reference.body_length != 0:
+            response_body_sim = jaccard(*reference.body, *live.body)
+
+        sim_score = response_code_sim + jaccard_request_sim + response_body_sim
+
+        if reference.headers:
+            if any(header in live.lowered for header in reference.headers):
+                sim_score += 1
+            else:
+                sim_score -= 1
+
+        scores[server_name] = sim_score
+
+    return scores
+
+
+def best_server(scores):
+    """ picks the server with the highest score above the threshold """
+
+    max_sim_server = "unknown"
+    max_sim_score = float("-inf")
+
+    for server_name, sim_score in scores.items():
+        if sim_score >= max_sim_score and sim_score >= THRESHOLD:
+            max_sim_score = sim_score
+            max_sim_server = server_name
+
+    return max_sim_server
+
+
+def score_margin(scores):
+    """ how far the best server is ahead of the runner-up, 0 when no server is matched """
+
+    ranked = sorted(scores.values(), reverse=True)
+    if not ranked or ranked[0] < THRESHOLD:
+        return 0.0
+    if len(ranked) == 1:
+        return ranked[0] - THRESHOLD
+    return ranked[0] - ranked[1]
+
+
+def vectorized_available():
+    """ whether numpy is installed for the vectorized scorer """
+
+    return np is not None
+
+
+class VectorScorer():
+    """
+        NumPy scorer that compares responses against all the reference servers
+        of an entry at once. Tokens are mapped to columns through a vocabulary
+        built from the reference responses. Tokens outside of it can only add
+        to the union, so they are counted by the response size alone. The
+        intersections and unions are the same integers as in score_servers and
+        are combined with the same float operations, so the scores are equal
+        (tolerance 0) and the threshold and header bonuses decide the same way.
+        When a reference cannot be parsed or an empty token set would be
+        compared, the pure Python scorer is used so the same exception is raised.
+        Building the response vectors only pays off over a batch, a single
+        response is scored faster by score_servers, so the probes use that.
+    """
+    def __init__(self, features):
+        if np is None:
+            raise RuntimeError("the vectorized scorer requires numpy")
+
+        self.features = features
+        self.server_names = list(features)
+        self.fallback = any(reference.error is not None for reference in features.values())
+        if self.fallback:
+            return
+
+        references = list(features.values())
+        self.code = self._matrix([reference.code for reference in references])
+        self.tokens = self._matrix([reference.tokens for reference in references])
+        self.body = self._matrix([reference.body for reference in references])
+        self.body_length = np.array([reference.body_length for reference in references])
+        self.has_headers = np.array([bool(reference.headers) for reference in references])
+
+    @staticmethod
+    def _matrix(token_sets):
+        """ returns the vocabulary, the count matrix and the sizes of the token sets """
+
+        vocabulary = {}
+        for tokens, _ in token_sets:
+            for token in tokens:
+                vocabulary.setdefault(token, len(vocabulary))
+
+        counts = np.zeros((len(token_sets), len(vocabulary)), dtype=np.int64)
+        for row, (tokens, _) in enumerate(token_sets):
+            for token, count in tokens.items():
+                counts[row, vocabulary[token]] = count
+
+        sizes = np.array([size for _, size in token_sets], dtype=np.int64)
+        return vocabulary, counts, sizes
+
+    @staticmethod
+    def _vectors(matrix, token_sets):
+        """ maps the live token sets onto the vocabulary of a reference matrix """
+
+        vocabulary = matrix[0]
+        vectors = np.zeros((len(token_sets), len(vocabulary)), dtype=np.int64)
+        for row, (tokens, _) in enumerate(token_sets):
+            for token, count in tokens.items():
+                column = vocabulary.get(token)
+                if column is not None:
+                    vectors[row, column] = count
+        sizes = np.array([size for _, size in token_sets], dtype=np.int64)
+        return vectors, sizes
+
+    @classmethod
+    def _jaccard(cls, matrix, token_sets):
+        """ (responses x servers) Jaccard similarities, None if a set pair is empty """
+
+        _, counts, reference_sizes = matrix
+        vectors, sizes = cls._vectors(matrix, token_sets)
+
+        intersection = np.minimum(vectors[:, None, :], counts[None, :, :]).sum(axis=2)
+        union = reference_sizes[None, :] + sizes[:, None] - intersection
+        empty = union == 0
+        return intersection / np.where(empty, 1, union), empty
+
+    def score_batch(self, responses):
+        """
+            Scores many responses together. Returns a server -> score dict per
+            response, or the exception raised while scoring it.
+        """
+
+        results = [None] * len(responses)
+        lives = []
+        rows = []
+        for row, response in enumerate(responses):
+            try:
+                lives.append(ResponseFeatures(response))
+                rows.append(row)
+            except Exception as exception:
+                results[row] = exception
+
+        if not self.features:
+            return [result if result is not None else {} for result in results]
+
+        if self.fallback:
+            for row, response in enumerate(responses):
+                if results[row] is None:
+                    results[row] = self._score_python(response)
+            return results
+
+        if lives:
+            code_sim, code_empty = self._jaccard(self.code, [live.code for live in lives])
+            full_sim, full_empty = self._jaccard(self.tokens, [live.tokens for live in lives])
+            body_sim, body_empty = self._jaccard(self.body, [live.body for live in lives])
+
+            live_body_length = np.array([live.body_length for live in lives])[:, None]
+            body_compared = (live_body_length != 0) & (self.body_length[None, :] != 0)
+            body_sim = np.where(body_compared, body_sim, 0.0)
+            body_sim = np.where((live_body_length <= 1) & (self.body_length[None, :] == 0),
+                                1.0, body_sim)
+
+            found = np.array([[any(header in live.lowered for header in reference.headers)
+                               for reference in self.features.values()] for live in lives])
+            bonus = np.where(self.has_headers[None, :], np.where(found, 1.0, -1.0), 0.0)
+
+            scores = code_sim + full_sim + body_sim + bonus
+            invalid = code_empty | full_empty | (body_compared & body_empty)
+
+            for position, row in enumerate(rows):
+                if invalid[position].any():
+                    results[row] = self._score_python(responses[row])
+                else:
+                    results[row] = dict(zip(self.server_names, scores[position].tolist()))
+
+        return results
+
+    def _score_python(self, response):
+        try:
+            return score_servers(response, self.features)
+        except Exception as exception:
+            return exception
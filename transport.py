@@ -0,0 +1,874 @@
+""" transport used to send the raw probes """
+
+import asyncio
+import re
+import ssl
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from instrumentation import get_instrumentation
+from scheduler import Deadlines, HostScheduler, RetryPolicy
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+USER_AGENT = b'User-Agent: Wget/1.21.4'
+TIMEOUT = 10
+RECV_SIZE = 16384
+DNS_TTL = 300
+REDIRECT_TTL = 300
+MAX_REDIRECTS = 15
+MAX_BODY = 65536
+MAX_HEAD = 65536
+# The repository requests refer to the target as hostname.
+PLACEHOLDER = b"hostname"
+
+
+class RedirectionDepthExceeded(Exception):
+    "Raised when the redirections are higher than 15."
+
+
+def unverified_context():
+    """ returns an SSL context that does not check the certificates """
+
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class ResponseFramer():
+    """
+        Follows the HTTP framing of a response while it is being read, so the
+        reader can stop as soon as the response is complete instead of waiting
+        for the server to close. Interim 1xx responses are kept and skipped.
+        Responses without Content-Length or chunked framing are read until the
+        server closes. The body is capped at max_body bytes, the head at MAX_HEAD.
+    """
+    def __init__(self, max_body=MAX_BODY):
+        self.max_body = max_body
+        # start of the head of the current response.
+        self.start = 0
+        self.body_start = None
+        self.content_length = None
+        self.chunked = False
+        self.chunk_position = None
+        self.until_close = False
+        # whether the server keeps the connection open after the response.
+        self.keep_alive = False
+        # whether the response ended where its framing says, nothing more was read.
+        self.framed = False
+
+    def _read_head(self, buffer, end):
+        """ parses the status line and the framing headers of the current response """
+
+        lines = bytes(buffer[self.start:end]).split(b'\r\n')
+        self.body_start = end + 4
+        try:
+            status_code = int(lines[0].split(b' ')[1])
+        except (IndexError, ValueError):
+            self.until_close = True
+            return None
+
+        self.keep_alive = lines[0].startswith(b'HTTP/1.1')
+
+        for header in lines[1:]:
+            name, _, value = header.partition(b':')
+            name = name.strip().lower()
+            if name == b'transfer-encoding' and b'chunked' in value.lower():
+                self.chunked = True
+                self.chunk_position = self.body_start
+            elif name == b'content-length' and not self.chunked:
+                try:
+                    self.content_length = int(value.strip())
+                except ValueError:
+                    self.until_close = True
+            elif name == b'connection':
+                self.keep_alive = self.keep_alive and b'close' not in value.lower()
+        return status_code
+
+    def _chunks_complete(self, buffer):
+        """ walks the chunks received so far, True once the last chunk is in """
+
+        while True:
+            line_end = buffer.find(b'\r\n', self.chunk_position)
+            if line_end == -1:
+                return False
+            try:
+                size = int(bytes(buffer[self.chunk_position:line_end]).split(b';')[0], 16)
+            except ValueError:
+                self.until_close = True
+                return False
+
+            if size == 0:
+                # the trailer section ends with an empty line.
+                if buffer[line_end + 2:line_end + 4] == b'\r\n':
+                    self.framed = len(buffer) == line_end + 4
+                    return True
+                trailer_end = buffer.find(b'\r\n\r\n', line_end)
+                if trailer_end == -1:
+                    return False
+                self.framed = len(buffer) == trailer_end + 4
+                return True
+
+            next_position = line_end + 2 + size + 2
+            if len(buffer) < next_position:
+                return False
+            self.chunk_position = next_position
+
+    def complete(self, buffer):
+        """ returns True once the buffer holds the whole response or max_body bytes of it """
+
+        while self.body_start is None:
+            end = buffer.find(b'\r\n\r\n', self.start)
+            if end == -1:
+                return len(buffer) - self.start > MAX_HEAD
+            status_code = self._read_head(buffer, end)
+            if status_code is not None and 100 <= status_code < 200 and status_code != 101:
+                self.start = self.body_start
+                self.body_start = None
+            elif status_code in (204, 304):
+                self.framed = len(buffer) == self.body_start
+                return True
+
+        if len(buffer) - self.body_start >= self.max_body:
+            return True
+        if self.until_close:
+            return False
+        if self.chunked:
+            return self._chunks_complete(buffer)
+        if self.content_length is not None:
+            received = len(buffer) - self.body_start
+            self.framed = received == self.content_length
+            return received >= self.content_length
+        return False
+
+    def reusable(self):
+        """ whether the connection can carry another request after the response """
+
+        return self.framed and self.keep_alive
+
+    def result(self, buffer):
+        """ returns the response bytes, without what is past the body limit """
+
+        if self.body_start is not None:
+            return bytes(buffer[:self.body_start + self.max_body])
+        return bytes(buffer[:self.start + MAX_HEAD])
+
+
+def read_response_stream(sock, max_body=MAX_BODY, on_first_byte=None, deadline=None,
+                         framer=None):
+    """
+        Reads a response from a blocking socket with recv_into until it is
+        complete. on_first_byte is called once the first bytes arrived. When a
+        deadline (time.monotonic) is given, socket.timeout is raised once it
+        passes, however slowly the bytes trickle in. A framer can be passed
+        to check afterwards whether the connection is reusable.
+    """
+
+    buffer = bytearray()
+    scratch = bytearray(RECV_SIZE)
+    view = memoryview(scratch)
+    if framer is None:
+        framer = ResponseFramer(max_body)
+
+    while True:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("read deadline exceeded")
+            sock.settimeout(remaining)
+        size = sock.recv_into(scratch)
+        if size == 0:
+            break
+        if on_first_byte is not None and not buffer:
+            on_first_byte()
+        buffer += view[:size]
+        if framer.complete(buffer):
+            break
+
+    return framer.result(buffer)
+
+
+async def read_response_stream_async(reader, timeout=TIMEOUT, max_body=MAX_BODY,
+                                     on_first_byte=None):
+    """ asyncio version of read_response_stream, timeout is the deadline of the whole response """
+
+    buffer = bytearray()
+    framer = ResponseFramer(max_body)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError
+        try:
+            data = await asyncio.wait_for(reader.read(RECV_SIZE), remaining)
+        except (ssl.SSLEOFError, ConnectionResetError):
+            # same as the ragged EOFs suppressed by the blocking socket.
+            break
+        if not data:
+            break
+        if on_first_byte is not None and not buffer:
+            on_first_byte()
+        buffer += data
+        if framer.complete(buffer):
+            break
+
+    return framer.result(buffer)
+
+
+class Session():
+    """
+        Shares the unverified SSL context, the DNS answers and the TLS sessions
+        between the probes, so they are not rebuilt for every connection.
+        The DNS, connect, TLS handshake and time to first byte timings go to
+        the instrumentation, the one of the process if None. Every connection
+        waits for the token bucket of its host, has connect and read deadlines
+        and is retried on transient connection failures.
+    """
+    def __init__(self, dns_ttl=DNS_TTL, reuse_tls_sessions=True, max_body=MAX_BODY,
+                 instrumentation=None, scheduler=None, deadlines=None, retry=None):
+        self.context = unverified_context()
+        self._instrumentation = instrumentation
+        self.scheduler = scheduler if scheduler is not None else HostScheduler()
+        self.deadlines = deadlines if deadlines is not None else Deadlines()
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.max_body = max_body
+        self.dns_ttl = dns_ttl
+        self.reuse_tls_sessions = reuse_tls_sessions
+        self.lock = threading.Lock()
+        # (host, port) -> (address, expiry time)
+        self.dns_cache = {}
+        # (host, port) -> ssl.SSLSession
+        self.tls_sessions = {}
+
+    @property
+    def instrumentation(self):
+        """ the instrumentation of the session, else the one of the process """
+
+        if self._instrumentation is not None:
+            return self._instrumentation
+        return get_instrumentation()
+
+    def _cached_address(self, key):
+        with self.lock:
+            cached = self.dns_cache.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def _store_address(self, key, infos):
+        address = infos[0][4]
+        with self.lock:
+            self.dns_cache[key] = (address, time.monotonic() + self.dns_ttl)
+        return address
+
+    def forget(self, host, port):
+        """ drops the cached DNS answer and TLS session of a host """
+
+        with self.lock:
+            self.dns_cache.pop((host, port), None)
+            self.tls_sessions.pop((host, port), None)
+
+    def resolve(self, host, port):
+        """ resolves the host, answers are cached for dns_ttl seconds """
+
+        address = self._cached_address((host, port))
+        if address is None:
+            with self.instrumentation.timer("dns"):
+                infos = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+            address = self._store_address((host, port), infos)
+        return address
+
+    async def resolve_async(self, host, port):
+        """ asyncio version of resolve """
+
+        address = self._cached_address((host, port))
+        if address is None:
+            with self.instrumentation.timer("dns"):
+                infos = await asyncio.get_running_loop().getaddrinfo(
+                    host, port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+            address = self._store_address((host, port), infos)
+        return address
+
+    def _on_retry(self, host):
+        """ returns the callback that records the retries of a host """
+
+        instrumentation = self.instrumentation
+
+        def on_retry(exception):
+            instrumentation.count("retries")
+            instrumentation.event("connect_retry", target=host, error=str(exception))
+        return on_retry
+
+    def connect(self, host, port):
+        """
+            Opens a TLS connection, resuming the last TLS session of the host if
+            any. Transient failures are retried with the retry policy.
+        """
+
+        if not isinstance(host, str):
+            host = host.decode()
+
+        return self.retry.call(lambda: self._connect(host, port), self._on_retry(host))
+
+    def _connect(self, host, port):
+        """ a single connection attempt """
+
+        self.scheduler.wait(host)
+
+        address = self.resolve(host, port)
+        with self.lock:
+            tls_session = self.tls_sessions.get((host, port))
+
+        instrumentation = self.instrumentation
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        start = time.monotonic()
+        deadline = start + self.deadlines.connect_timeout((host, port))
+        sock.settimeout(deadline - start)
+        try:
+            with instrumentation.timer("connect"):
+                sock.connect(address)
+            # the handshake gets what is left of the connect deadline.
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            with instrumentation.timer("tls_handshake", resumed=tls_session is not None):
+                ssock = self.context.wrap_socket(sock, server_hostname=host,
+                                                 session=tls_session)
+            self.deadlines.observe_connect((host, port), time.monotonic() - start)
+            return ssock
+        except socket.timeout:
+            sock.close()
+            raise
+        except OSError:
+            sock.close()
+            # the cached address or session may be stale.
+            self.forget(host, port)
+            raise
+
+    def keep_tls_session(self, host, port, ssock):
+        """ remembers the TLS session of a connection for the next handshake """
+
+        if not isinstance(host, str):
+            host = host.decode()
+
+        if self.reuse_tls_sessions and ssock.session is not None:
+            with self.lock:
+                self.tls_sessions[(host, port)] = ssock.session
+
+    def send_on(self, ssock, host, port, request):
+        """
+            Sends the raw request on an open connection and reads the response
+            until it is complete, or raises socket.timeout once the read
+            deadline passes. Returns the response and whether the connection
+            can carry another request.
+        """
+
+        instrumentation = self.instrumentation
+
+        deadline = time.monotonic() + self.deadlines.read_timeout((host, port))
+        ssock.settimeout(deadline - time.monotonic())
+        ssock.sendall(request)
+        sent = time.monotonic()
+
+        def on_first_byte():
+            ttfb = time.monotonic() - sent
+            self.deadlines.observe_response((host, port), ttfb)
+            instrumentation.observe("ttfb", ttfb)
+
+        framer = ResponseFramer(self.max_body)
+        response = read_response_stream(ssock, self.max_body, on_first_byte, deadline, framer)
+        return response, framer.reusable()
+
+    def exchange(self, host, port, request):
+        """ opens a connection, sends the raw request and reads the response, see send_on """
+
+        if not isinstance(host, str):
+            host = host.decode()
+
+        with self.connect(host, port) as ssock:
+            response, _ = self.send_on(ssock, host, port, request)
+
+            # TLS 1.3 tickets arrive after the handshake, so keep the session at the end.
+            self.keep_tls_session(host, port, ssock)
+        return response
+
+
+_DEFAULT_SESSION = Session()
+
+def get_session():
+    """ returns the session shared by the whole process """
+
+    return _DEFAULT_SESSION
+
+
+def build_request(target, path, request, from_redirection):
+    """
+        Puts the path, the hostname and the User-Agent into a repository request.
+        The rest of the request is kept byte by byte. The request can also be
+        a RequestTemplate of it.
+    """
+
+    if isinstance(request, RequestTemplate):
+        return request.render(target, path, from_redirection)
+
+    if isinstance(path, str):
+        path = path.encode()
+
+    # If path == "/" no need to prepend something.
+    if path in [b"/", b""]:
+        pass
+    else:
+        request_line = request[:request.find(b"\r\n")]
+        rest = request[request.find(b"\r\n"):]
+
+        splitted_request_line = request_line.split(b" ")
+
+        curr_path = splitted_request_line[1]
+
+        if from_redirection is True:
+            splitted_request_line[1] = path
+        elif curr_path == b"/" and path[-1] == b"/":
+            splitted_request_line[1] = path
+        elif curr_path == b"/":
+            splitted_request_line[1] = path
+        else:
+            new_path = path + curr_path
+            splitted_request_line[1] = new_path
+
+        new_request_line = b" ".join(splitted_request_line)
+        request = new_request_line + rest
+
+    if not isinstance(target, str):
+        target = target.decode()
+    request = re.sub(b'hostname', bytes(target, 'utf-8'), request)
+
+    # Adds User-Agent.
+    user_agent_request_line = request.split(b"\r\n")[:1]
+    user_agent_rest = request.split(b"\r\n")[1:]
+    user_agent_request_line.append(USER_AGENT)
+    user_agent_request_line.extend(user_agent_rest)
+    return b"\r\n".join(user_agent_request_line)
+
+
+class RequestTemplate():
+    """
+        A repository request compiled once for build_request. The request is
+        split at the path of its request line, at the end of the request line
+        where the User-Agent goes, and at the hostname placeholders, so that
+        rendering a probe is a single join of the pieces instead of splitting,
+        substituting and joining the whole request again.
+    """
+    __slots__ = ("request", "pieces", "path_slot", "path")
+
+    def __init__(self, request):
+        self.request = request
+        # pieces of the rendered request, None stands for the target.
+        self.pieces = None
+        self.path_slot = None
+        self.path = None
+
+        line_end = request.find(b"\r\n")
+        path_start = request.find(b" ", 0, line_end) + 1
+        # build_request fails on a request line without a path, let it do so.
+        if line_end < 0 or path_start == 0:
+            return
+
+        path_end = request.find(b" ", path_start, line_end)
+        if path_end < 0:
+            path_end = line_end
+
+        def split(data):
+            pieces = []
+            for piece in data.split(PLACEHOLDER):
+                pieces.extend((piece, None))
+            return pieces[:-1]
+
+        self.path = request[path_start:path_end]
+        # the path is the only part that changes with the scanned path, the
+        # pieces around it are separated by a space or a CRLF from it, so no
+        # placeholder spans two pieces.
+        self.pieces = split(request[:path_start])
+        self.path_slot = len(self.pieces)
+        self.pieces.append(None)
+        self.pieces.extend(split(request[path_end:line_end]))
+        self.pieces.append(b"\r\n" + USER_AGENT)
+        self.pieces.extend(split(request[line_end:]))
+
+    def render(self, target, path, from_redirection):
+        """ returns the same bytes as build_request for the request """
+
+        if not isinstance(target, str):
+            target = target.decode()
+        if isinstance(path, str):
+            path = path.encode()
+        target = target.encode()
+
+        # a CR or LF moves the end of the request line, and re.sub expands the
+        # backslash escapes of the target, leave these to build_request.
+        if (self.pieces is None or b"\r" in target or b"\n" in target or b"\\" in target
+                or b"\r" in path or b"\n" in path):
+            return build_request(target, path, self.request, from_redirection)
+
+        if path in [b"/", b""]:
+            segment = self.path
+        elif from_redirection is True or self.path == b"/":
+            segment = path
+        else:
+            segment = path + self.path
+        if PLACEHOLDER in segment:
+            segment = segment.replace(PLACEHOLDER, target)
+
+        pieces = [target if piece is None else piece for piece in self.pieces]
+        pieces[self.path_slot] = segment
+        return b"".join(pieces)
+
+
+def request_template(resp):
+    """ returns the RequestTemplate of a repository entry, compiled once """
+
+    template = getattr(resp, "template", None)
+    if template is None:
+        template = RequestTemplate(resp.after_mut.encode())
+        resp.template = template
+    return template
+
+
+def redirect_check(response, server_n, path):
+    """ checks redirects """
+
+    try:
+        lines = response.split(b'\r\n')
+        status_line = lines[0]
+        headers = lines[1:]
+        status_code = int(status_line.split(b' ')[1])
+
+        if status_code == 100:
+            response = response.split(b"\r\n\r\n", 1)[1]
+            lines = response.split(b'\r\n')
+            status_line = lines[0]
+            headers = lines[1:]
+            status_code = int(status_line.split(b' ')[1])
+
+        if status_code in REDIRECT_CODES:
+            for header in headers:
+                if header.lower().startswith(b'location:'):
+
+                    url = header.split(b':', 1)[1].strip()
+                    parse_results = urlparse(url)
+                    server_n = parse_results.hostname
+                    path = parse_results.path
+
+                    return True, server_n, path
+            return False, server_n, path
+        return False, server_n, path
+
+    except Exception as exception:
+        get_instrumentation().event("redirect_check_error", error=str(exception))
+        return False, server_n, path
+
+
+def redirect_check_request(server_n, path, keep_alive=False):
+    """ returns the request used in the initial redirection check """
+
+    if not isinstance(server_n, str):
+        server_n = server_n.decode()
+    if not isinstance(path, str):
+        path = path.decode()
+    connection = "keep-alive" if keep_alive else "close"
+
+    return (f"GET {path} HTTP/1.1\r\nHost: {server_n}\r\nUser-Agent: Wget/1.21.4\r\n"
+            f"Connection: {connection}\r\n\r\n").encode()
+
+
+def follow_redirect(response, server_n, path):
+    """
+        Parses an initial redirection check response. Returns whether it redirects
+        and the hostname and path of the next hop.
+    """
+
+    # parse the response.
+    lines = response.split(b'\r\n')
+    status_line = lines[0]
+    headers = lines[1:]
+    status_code = int(status_line.split(b' ')[1])
+
+    # if status code is not redirect, return the hostname and path.
+    if status_code not in REDIRECT_CODES:
+        return False, server_n, path
+
+    # search for the "Location" header.
+    for header in headers:
+        if header.lower().startswith(b'location:'):
+            # parse the url in the Location header.
+            url = header.split(b':', 1)[1].strip()
+            parse_results = urlparse(url)
+            server_n = parse_results.hostname
+            path = parse_results.path
+
+    return True, server_n, path
+
+
+class RedirectResolver():
+    """
+        Follows the initial redirects of the targets. A redirect to the same
+        host is followed on the same connection when the server keeps it open,
+        and the final hostname and path of every hop are memoized for ttl
+        seconds, so the targets that share a domain or a redirect resolve it
+        once. Safe to share between threads.
+    """
+    def __init__(self, session=None, ttl=REDIRECT_TTL, max_redirects=MAX_REDIRECTS):
+        self.session = session if session is not None else get_session()
+        self.ttl = ttl
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        # (host, port, path) -> ((hostname, path), expiry time)
+        self.resolved = {}
+        self.hits = 0
+
+    @staticmethod
+    def _key(server_n, port, path):
+        if not isinstance(server_n, str):
+            server_n = server_n.decode()
+        if isinstance(path, str):
+            path = path.encode()
+        return server_n.lower(), port, path
+
+    def _cached(self, key):
+        with self.lock:
+            cached = self.resolved.get(key)
+            if cached is None:
+                return None
+            if cached[1] <= time.monotonic():
+                del self.resolved[key]
+                return None
+            self.hits += 1
+            return cached[0]
+
+    def _store(self, keys, result):
+        if self.ttl <= 0:
+            return
+        expiry = time.monotonic() + self.ttl
+        with self.lock:
+            for key in keys:
+                self.resolved[key] = (result, expiry)
+
+    def resolve(self, server_n, path, port=443):
+        """
+            Returns the hostname and path that the target finally redirects to,
+            like initial_redirect_check: (None, "redirect count exceeded") after
+            max_redirects redirects, the current hop when a request fails.
+        """
+
+        session = self.session
+        hops = []
+        ssock = None
+        # hostname of the open connection.
+        connected = None
+        # an empty last response may be transient, so it is not memoized.
+        memoize = True
+
+        try:
+            for _ in range(self.max_redirects):
+                key = self._key(server_n, port, path)
+                result = self._cached(key)
+                if result is not None:
+                    break
+                hops.append(key)
+
+                request = redirect_check_request(server_n, path, keep_alive=True)
+                if isinstance(path, str):
+                    path = path.encode()
+                host = server_n if isinstance(server_n, str) else server_n.decode()
+
+                # a redirect to the same host reuses the connection when possible.
+                reused = ssock is not None and connected.lower() == key[0]
+                if not reused:
+                    if ssock is not None:
+                        session.keep_tls_session(connected, port, ssock)
+                        ssock.close()
+                    ssock = session.connect(host, port)
+                    connected = host
+
+                try:
+                    response, reusable = session.send_on(ssock, host, port, request)
+                except (ConnectionError, ssl.SSLError, socket.timeout):
+                    if not reused:
+                        raise
+                    response = b""
+
+                if reused and len(response) == 0:
+                    # the server closed the kept-alive connection in the meantime, or
+                    # keeps it open without answering, the GET is sent again on a new
+                    # connection like HTTP clients do.
+                    ssock.close()
+                    ssock = session.connect(host, port)
+                    response, reusable = session.send_on(ssock, host, port, request)
+
+                if not reusable:
+                    session.keep_tls_session(host, port, ssock)
+                    ssock.close()
+                    ssock = None
+
+                if len(response) == 0:
+                    result = (server_n, path)
+                    memoize = False
+                    break
+
+                redirect, server_n, path = follow_redirect(response, server_n, path)
+                if not redirect:
+                    result = (server_n, path)
+                    break
+            else:
+                result = (None, "redirect count exceeded")
+
+        except Exception:
+            # a failure may be transient, so it is not memoized.
+            return server_n, path
+        finally:
+            if ssock is not None:
+                session.keep_tls_session(connected, port, ssock)
+                ssock.close()
+
+        if memoize:
+            self._store(hops, result)
+        return result
+
+    def lookup(self, server_n, path="/", port=443):
+        """ the memoized result of a target, None if it was not resolved or expired """
+
+        return self._cached(self._key(server_n, port, path))
+
+    def remember(self, server_n, result, path="/", port=443):
+        """ memoizes the result of a target resolved elsewhere, e.g. in another process """
+
+        self._store([self._key(server_n, port, path)], result)
+
+    def prefetch(self, targets, port=443, workers=16):
+        """ resolves the redirects of the targets concurrently, the results are memoized """
+
+        targets = list(targets)
+        if not targets:
+            return
+        with ThreadPoolExecutor(max_workers=min(workers, len(targets))) as executor:
+            list(executor.map(lambda target: self.resolve(target, "/", port), targets))
+
+
+async def exchange_async(target, port, request, timeout=None, session=None):
+    """
+        Sends the raw request over TLS and reads the response until it is
+        complete. asyncio streams cannot resume TLS sessions, so only the SSL
+        context, the DNS answers, the host token buckets, the deadlines and
+        the retry policy of the session are shared. A timeout overrides both
+        deadlines of the session.
+    """
+
+    if session is None:
+        session = get_session()
+    if not isinstance(target, str):
+        target = target.decode()
+
+    instrumentation = session.instrumentation
+    key = (target, port)
+    connect_timeout = timeout if timeout is not None else session.deadlines.connect_timeout(key)
+    read_timeout = timeout if timeout is not None else session.deadlines.read_timeout(key)
+
+    async def connect():
+        await session.scheduler.wait_async(target)
+        start = time.monotonic()
+        address = await asyncio.wait_for(session.resolve_async(target, port), connect_timeout)
+        # asyncio does the TCP connect and the TLS handshake in one step.
+        with instrumentation.timer("connect_tls_handshake"):
+            streams = await asyncio.wait_for(
+                asyncio.open_connection(address[0], address[1], ssl=session.context,
+                                        server_hostname=target),
+                connect_timeout)
+        session.deadlines.observe_connect(key, time.monotonic() - start)
+        return streams
+
+    reader, writer = await session.retry.call_async(connect, session._on_retry(target))
+
+    try:
+        writer.write(request)
+        await asyncio.wait_for(writer.drain(), read_timeout)
+        sent = time.monotonic()
+
+        def on_first_byte():
+            ttfb = time.monotonic() - sent
+            session.deadlines.observe_response(key, ttfb)
+            instrumentation.observe("ttfb", ttfb)
+
+        return await read_response_stream_async(reader, read_timeout, session.max_body,
+                                                on_first_byte)
+    finally:
+        # the response is read, no need to wait for the TLS shutdown of the server.
+        writer.transport.abort()
+
+
+async def send_request_async(target, port, path, request, from_redirection, depth=0,
+                             session=None):
+    """ asyncio version of send_request, sends a request and return the response """
+
+    if session is None:
+        session = get_session()
+
+    try:
+        if isinstance(path, str):
+            path = path.encode()
+
+        if depth > 15:
+            raise RedirectionDepthExceeded
+
+        original_request = request
+        request = build_request(target, path, request, from_redirection)
+
+        response = await exchange_async(target, port, request, session=session)
+
+        if len(response) == 0:
+            return response
+
+        redirect, server_n_r, path_r = redirect_check(response, target, path)
+
+        if redirect is False:
+            return response
+        return await send_request_async(server_n_r, port, path_r, original_request,
+                                        True, depth=depth+1, session=session)
+    except RedirectionDepthExceeded:
+        session.instrumentation.event("redirection_depth_exceeded", target=target)
+        return "exception"
+    except asyncio.TimeoutError:
+        return "too_long"
+    except Exception as exception:
+        session.instrumentation.event("probe_error", target=target, error=str(exception))
+        return "exception"
+
+
+async def initial_redirect_check_async(server_n, path, session=None, port=443):
+    """ asyncio version of initial_redirect_check """
+
+    redirect_count = 0
+
+    try:
+        while True:
+
+            # if redirect count is larger or equal to 15, redirect count exceeded.
+            if redirect_count >= 15:
+                return None, "redirect count exceeded"
+
+            request = redirect_check_request(server_n, path)
+            redirect_count += 1
+
+            if isinstance(path, str):
+                path = path.encode()
+
+            response = await exchange_async(server_n, port, request, session=session)
+
+            if len(response) == 0:
+                return server_n, path
+
+            redirect, server_n, path = follow_redirect(response, server_n, path)
+            if not redirect:
+                return server_n, path
+
+    except Exception:
+        return server_n, path
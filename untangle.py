@@ -3,17 +3,24 @@
     Written by Cem Topcuoglu for Untangle: Multi-Layer Web Server Fingerprinting accepted in NDSS.
 """
 
-import json
-import time
-import random
-from urllib.parse import urlparse
-import re
-import ssl
+import sys
 import socket
 from statistics import mode
-import pickle
 import configargparse
-from simphile import jaccard_similarity
+from helper import SERVER_LIST
+from repository import get_repository
+from cache import (ResponseCache, ResultCache, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+                   RESULT_CACHE_TTL)
+from instrumentation import Instrumentation, JSONLinesSink, Registry, set_instrumentation
+from scan import read_targets, resolve_ahead, scan_targets, scan_targets_processes
+from scoring import (VectorScorer, as_features, best_server, reference_features,
+                     score_margin, score_servers)
+from planner import LayerEvidence, ProbePlanner
+from scheduler import (ProbeDispatcher, HostScheduler, Deadlines, RetryPolicy, CONNECT_TIMEOUT,
+                       READ_TIMEOUT, RETRIES, RETRY_BACKOFF)
+from transport import (RedirectionDepthExceeded, RedirectResolver, Session, get_session,
+                       build_request, request_template, redirect_check, REDIRECT_TTL,
+                       MAX_BODY)
 
 def arg_parse():
     """ Argument parser. """
@@ -21,59 +28,158 @@ def arg_parse():
     parser = configargparse.ArgParser(description='Web Server fingerprinting tool.')
     parser.add('-t', dest="target", type=str,
                help="Please input the target address that you want to fingerprint.")
+    parser.add('-r', dest="repository", type=str,
+               help="Behavior repository to use, by default behavior_repository.jsonl if it "
+                    "exists, else behavior_repository.bin if it exists, else "
+                    "behavior_repository.out.")
+    parser.add('-f', dest="targets_file", type=str,
+               help="File with one target per line to fingerprint in batch mode, - for stdin.")
+    parser.add('-o', dest="output", type=str, default="-",
+               help="Batch mode output file for the JSON line results, - for stdout.")
+    parser.add('-w', dest="workers", type=int, default=16,
+               help="Number of targets fingerprinted concurrently in batch mode.")
+    parser.add('--processes', dest="processes", type=int, default=1,
+               help="Number of scan processes in batch mode, each with -w threads. The "
+                    "processes share the behavior repository and its scoring features. The "
+                    "targets are sharded by the host they redirect to, so that --rate holds "
+                    "across processes, except for the redirects that are not resolved "
+                    "ahead (--redirect-window 0, failures), sharded by their own name.")
+    parser.add('--per-host', dest="per_host", type=int, default=1,
+               help="Maximum number of concurrent scans of the same host in batch mode.")
+    parser.add('--in-flight', dest="max_in_flight", type=int, default=8,
+               help="Maximum number of probes in flight to a target in Phase 2 and Phase 3.")
+    parser.add('--rate', dest="rate", type=float, default=10,
+               help="Maximum number of connections per second to a host, 0 for no limit.")
+    parser.add('--burst', dest="burst", type=int, default=1,
+               help="Number of connections to a host allowed at once before --rate applies.")
+    parser.add('--connect-timeout', dest="connect_timeout", type=float, default=CONNECT_TIMEOUT,
+               help="Seconds allowed for the TCP connect and the TLS handshake.")
+    parser.add('--read-timeout', dest="read_timeout", type=float, default=READ_TIMEOUT,
+               help="Seconds allowed for reading a whole response, a server that is still "
+                    "silent then is recorded as too_long.")
+    parser.add('--adaptive-timeouts', dest="adaptive_timeouts", action="store_true",
+               help="Lower the timeouts of a target from its observed round trip times, "
+                    "the options above are the upper bounds.")
+    parser.add('--retries', dest="retries", type=int, default=RETRIES,
+               help="Number of retries of a connection that failed or timed out.")
+    parser.add('--retry-backoff', dest="retry_backoff", type=float, default=RETRY_BACKOFF,
+               help="Base seconds of the exponential backoff between the retries.")
+    parser.add('--adaptive', dest="adaptive", action="store_true",
+               help="In Phase 2, only send the probes that split the remaining candidate "
+                    "servers instead of every eligible probe.")
+    parser.add('--confidence', dest="confidence", type=float, default=0,
+               help="In Phase 2 and Phase 3, stop probing a layer once a server is the next "
+                    "layer with this confidence (0 to 1). 0 sends every probe.")
+    parser.add('--response-cache-size', dest="cache_size", type=int,
+               default=RESPONSE_CACHE_SIZE,
+               help="Number of responses cached per target to skip identical probes, 0 disables.")
+    parser.add('--response-cache-ttl', dest="cache_ttl", type=float,
+               default=RESPONSE_CACHE_TTL,
+               help="Seconds a cached response is reused for.")
+    parser.add('--result-cache', dest="result_cache", type=str,
+               help="SQLite file caching the fingerprinted chains between runs. A cached "
+                    "chain is verified with one or two probes instead of being discovered again.")
+    parser.add('--result-cache-ttl', dest="result_cache_ttl", type=float,
+               default=RESULT_CACHE_TTL,
+               help="Seconds a cached chain is verified instead of discovered again.")
+    parser.add('--redirect-window', dest="redirect_window", type=int, default=64,
+               help="In batch mode, the initial redirects of this many targets are resolved "
+                    "concurrently before they are fingerprinted, 0 disables it.")
+    parser.add('--redirect-ttl', dest="redirect_ttl", type=float, default=REDIRECT_TTL,
+               help="Seconds a resolved initial redirect is reused by the targets of a batch.")
+    parser.add('--dns-ttl', dest="dns_ttl", type=float, default=300,
+               help="Seconds a resolved hostname is cached for.")
+    parser.add('--max-body', dest="max_body", type=int, default=MAX_BODY,
+               help="Maximum number of response body bytes read per probe.")
+    parser.add('--no-tls-resumption', dest="tls_resumption", action="store_false",
+               help="Do a full TLS handshake for every probe instead of resuming sessions.")
+    parser.add('--metrics', dest="metrics", type=str,
+               help="File to write the probe timings, counters and errors to as JSON lines, "
+                    "- for stderr.")
+    parser.add('--stats', dest="stats", action="store_true",
+               help="Print a summary of the probe timings and counters to stderr at the end.")
     args = parser.parse_args()
 
     return args
 
 class Servers():
     """ holds the server_list also, it holds reactions of these servers """
-    def __init__(self):
-        self.server_list = ["cloudfront", "cloudflare", "fastly", "akamai", "nginx",
-                            "varnish", "haproxy", "apache", "caddy", "envoy", "ats",
-                            "squid", "tomcat"]
-        self.server_dict = {"cloudfront": 0, "cloudflare": 1, "fastly": 2, "akamai": 3,
-                            "nginx": 4, "varnish": 5, "haproxy": 6, "apache": 7, "caddy": 8,
-                            "envoy": 9, "ats": 10, "squid": 11, "tomcat": 12}
+    def __init__(self, server_list=None):
+        # the servers of the behavior repository, helper.SERVER_LIST by default.
+        self.server_list = list(server_list if server_list is not None else SERVER_LIST)
+        self.server_dict = {server: idx for idx, server in enumerate(self.server_list)}
         self.server_reaction_list = [0]*len(self.server_list)
 
-class RedirectionDepthExceeded(Exception):
-    "Raised when the redirections are higher than 15."
-
-def redirect_check(response, server_n, path):
-    """ checks redirects """
-
-    try:
-        lines = response.split(b'\r\n')
-        status_line = lines[0]
-        headers = lines[1:]
-        status_code = int(status_line.split(b' ')[1])
-
-        if status_code == 100:
-            response = response.split(b"\r\n\r\n", 1)[1]
-            lines = response.split(b'\r\n')
-            status_line = lines[0]
-            headers = lines[1:]
-            status_code = int(status_line.split(b' ')[1])
-
-        if status_code in (301, 302, 303, 307, 308):
-            for header in headers:
-                if header.lower().startswith(b'location:'):
-
-                    url = header.split(b':', 1)[1].strip()
-                    parse_results = urlparse(url)
-                    server_n = parse_results.hostname
-                    path = parse_results.path
-
-                    return True, server_n, path
-            return False, server_n, path
-        return False, server_n, path
+class ScanContext():
+    """ holds the settings shared by the probes of a single target """
+    def __init__(self, max_in_flight=8, session=None, repository=None,
+                 cache_size=RESPONSE_CACHE_SIZE, cache_ttl=RESPONSE_CACHE_TTL,
+                 adaptive=False, instrumentation=None, result_cache=None, redirects=None,
+                 confidence=0):
+        self.dispatcher = ProbeDispatcher(max_in_flight)
+        self.session = session if session is not None else get_session()
+        if instrumentation is None:
+            instrumentation = self.session.instrumentation
+        self.instrumentation = instrumentation
+        # loaded on first use, a single probe of a given entry does not need it.
+        self._repository = repository
+        self.response_cache = ResponseCache(cache_size, cache_ttl)
+        self.adaptive = adaptive
+        # confidence at which Phase 2 and Phase 3 stop probing a layer, 0 never stops.
+        self.confidence = confidence
+        # Phase 2 and Phase 3 probes skipped compared to the exhaustive scan.
+        self.probes_saved = 0
+        # confidence of the layer found by the last find_layer call, None if unknown.
+        self.layer_confidence = None
+        # confidence of every found layer, None for the cached chains.
+        self.confidences = []
+        self.result_cache = result_cache
+        # resolves the initial redirects, shared by the targets of a batch.
+        self.redirects = redirects if redirects is not None else RedirectResolver(self.session,
+                                                                                 ttl=0)
+        # (target reaction tuple, outcome) of the Phase 1 probes, in the layer order.
+        self.phase1_probes = []
+
+    @property
+    def repository(self):
+        """ the repository of the scan, the default one of the process if None was given """
+
+        if self._repository is None:
+            self._repository = get_repository()
+        return self._repository
+
+def context_from_args(arg, session, repository, result_cache=None, redirects=None):
+    """ returns a new scan context with the command line settings """
+
+    return ScanContext(max_in_flight=arg.max_in_flight, session=session,
+                       repository=repository, cache_size=arg.cache_size, cache_ttl=arg.cache_ttl,
+                       adaptive=arg.adaptive, instrumentation=session.instrumentation,
+                       result_cache=result_cache, redirects=redirects,
+                       confidence=arg.confidence)
+
+def result_cache_from_args(arg):
+    """ opens the result cache of the command line, None if there is none """
+
+    if arg.result_cache is None:
+        return None
+    return ResultCache(arg.result_cache, arg.result_cache_ttl)
+
+def session_from_args(arg):
+    """ returns a transport session with the command line settings """
+
+    return Session(arg.dns_ttl, arg.tls_resumption, arg.max_body,
+                   scheduler=HostScheduler(arg.rate, arg.burst),
+                   deadlines=Deadlines(arg.connect_timeout, arg.read_timeout,
+                                       arg.adaptive_timeouts),
+                   retry=RetryPolicy(arg.retries, arg.retry_backoff))
+
+def send_request(target, port, path, request, from_redirection, depth=0, session=None):
+    """ sends a request and return the response """
 
-    except Exception as exception:
-        print("here1 up", exception)
-        return False, server_n, path
+    if session is None:
+        session = get_session()
 
-def send_request(target, port, path, request, from_redirection, depth=0):
-    """ sends a request and return the response """
+    instrumentation = session.instrumentation
 
     try:
         if isinstance(path, str):
@@ -82,88 +188,31 @@ def send_request(target, port, path, request, from_redirection, depth=0):
         if depth > 15:
             raise RedirectionDepthExceeded
 
-        _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
         original_request = request
+        request = build_request(target, path, request, from_redirection)
 
-        # If path == "/" no need to prepend something.
-        if path in [b"/", b""]:
-            pass
-        else:
-            request_line = request[:request.find(b"\r\n")]
-            rest = request[request.find(b"\r\n"):]
+        instrumentation.count("requests", redirected=from_redirection)
+        response = session.exchange(target, port, request)
 
-            splitted_request_line = request_line.split(b" ")
-
-            curr_path = splitted_request_line[1]
-
-            if from_redirection is True:
-                splitted_request_line[1] = path
-            elif curr_path == b"/" and path[-1] == b"/":
-                splitted_request_line[1] = path
-            elif curr_path == b"/":
-                splitted_request_line[1] = path
-            else:
-                new_path = path + curr_path
-                splitted_request_line[1] = new_path
-
-            new_request_line = b" ".join(splitted_request_line)
-            request = new_request_line + rest
-
-        if isinstance(target, str):
-            pass
-        else:
-            target = target.decode()
-        request = re.sub(b'hostname', bytes(target, 'utf-8'), request)
-
-        # Adds User-Agent.
-        user_agent_string = b'User-Agent: Wget/1.21.4'
-        user_agent_request_line = request.split(b"\r\n")[:1]
-        user_agent_rest = request.split(b"\r\n")[1:]
-        user_agent_request_line.append(user_agent_string)
-        user_agent_request_line.extend(user_agent_rest)
-        new_req = b"\r\n".join(user_agent_request_line)
-        request = new_req
-
-        ssl._create_default_https_context = ssl._create_unverified_context
-        ssl.match_hostname = lambda cert, hostname: True
-        context = ssl.create_default_context()
-
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-
-        with context.wrap_socket(_socket, server_hostname=target) as s:
-
-            s.settimeout(10)
-            s.connect((target, port))
-            s.sendall(request)
-
-            response = b''
-            while True:
-                data = s.recv(2048)
-                if not data:
-                    break
-                response += data
-
-            s.close()
-
-            if len(response) == 0:
-                return response
+        if len(response) == 0:
+            return response
 
+        with instrumentation.timer("redirect_check"):
             redirect, server_n_r, path_r = redirect_check(response, target, path)
 
-            if redirect is False:
-                return response
-            response = send_request(server_n_r, port, path_r, original_request,
-                                        True, depth=depth+1)
+        if redirect is False:
             return response
+        response = send_request(server_n_r, port, path_r, original_request,
+                                True, depth=depth+1, session=session)
+        return response
     except RedirectionDepthExceeded:
-        print("Redirection depth exceeded")
+        instrumentation.event("redirection_depth_exceeded", target=target)
         return "exception"
     except socket.timeout:
+        instrumentation.count("timeouts")
         return "too_long"
     except Exception as exception:
-        print(exception)
+        instrumentation.event("probe_error", target=target, error=str(exception))
         return "exception"
 
 def pick_request(server_reaction_list):
@@ -172,102 +221,116 @@ def pick_request(server_reaction_list):
         list's requirements, if you cannot find return False
     """
 
-    with open("behavior_repository.out", "rb") as reader:
-        hashmap  = pickle.load(reader)
+    return get_repository().pick(server_reaction_list)
 
-        if str(server_reaction_list) in hashmap:
-            return hashmap[str(server_reaction_list)]
-        return False
+def prepare_repository(repository):
+    """
+        Decodes the probed entry of every reaction vector and builds its
+        scoring features once, e.g. before the scan processes fork, so they
+        share them instead of building their own.
+    """
+
+    entries = repository.entries
+    for reaction in entries:
+        _, resp = entries[reaction][0]
+        reference_features(resp)
 
 def read_response(response, original_responses):
     """ Reads the response and matches to a server with highest similarity score """
 
-    max_sim_server = "unknown"
-    max_sim_score = float("-inf")
-
-    for server_name in original_responses:
-        comp = original_responses[server_name].encode()
-
-        comp_code = comp[comp.find(b'HTTP'):].split(b'\r\n')[0].split(b" ")[1].lower()
-        response_code = response.split(b'\r\n')[0].split(b" ")[1].lower()
-        response_code_sim = jaccard_similarity(comp_code, response_code)
-
-        response = response.lower()
-        comp = comp.lower()
-        jaccard_request_sim = jaccard_similarity(comp, response)
+    return best_server(score_servers(response, as_features(original_responses)))
 
-        response_body_sim = 0
-        curr_body_text = comp.split(b'\r\n\r\n')[1].lower()
-        response_body_text = response.split(b'\r\n\r\n')[1].lower()
-
-        if len(response_body_text) <= 1 and len(curr_body_text) == 0:
-            response_body_sim = 1
-        elif len(response_body_text) != 0 and len(curr_body_text) != 0:
-            response_body_sim = jaccard_similarity(curr_body_text, response_body_text)
-
-        sim_score = response_code_sim + jaccard_request_sim + response_body_sim
+def read_responses(responses, original_responses):
+    """
+        Matches many responses against the same reference responses in one
+        batched NumPy operation, e.g. to rescore stored scans.
+    """
 
-        if server_name == "fastly":
-            if b"x-served-by:".lower() in response:
-                sim_score += 1
-            else:
-                sim_score -= 1
-        if server_name == "cloudfront":
-            if b"x-amz-cf-pop:".lower() in response or b"x-amz-cf-id".lower() in response:
-                sim_score += 1
-            else:
-                sim_score -= 1
-        if server_name == "cloudflare":
-            if b"CF-Cache-Status:".lower() in response or b"CF-RAY".lower() in response:
-                sim_score += 1
-            else:
-                sim_score -= 1
+    results = VectorScorer(as_features(original_responses)).score_batch(responses)
+    return ["exception" if isinstance(scores, Exception) else best_server(scores)
+            for scores in results]
 
-        if sim_score >= max_sim_score and sim_score >= 1.8222222222222224:
-            max_sim_score = sim_score
-            max_sim_server = server_name
+def send_request_and_fingerprint(resp_tuple, server_n, server_p, path, context=None):
+    """ send a request and fingerprint the response """
 
-    return max_sim_server
+    return fingerprint_probe(resp_tuple, server_n, server_p, path, context)[0]
 
+def fingerprint_probe(resp_tuple, server_n, server_p, path, context=None):
+    """
+        Like send_request_and_fingerprint, but also returns the scoring margin
+        of the predicted server over the runner-up, 0 if nothing was scored.
+    """
 
-def send_request_and_fingerprint(resp_tuple, server_n, server_p, path):
-    """ send a request and fingerprint the response """
+    if context is None:
+        context = ScanContext()
 
     _, resp = resp_tuple[0]
-    picked_r = resp.after_mut.encode()
+    # the request is compiled once per repository entry.
+    template = request_template(resp)
 
-    time.sleep(random.randint(0, 10)/10)
+    # The session spaces out the connections to the host.
+    def send():
+        return send_request(server_n, server_p, path, template, False, session=context.session)
 
-    response = send_request(server_n, server_p, path, picked_r, False)
+    # A byte-identical request to the same host, port and path is answered from the cache.
+    response = context.response_cache.fetch((server_n, server_p, path, template.request), send)
 
     if response in ["too_long", "exception"]:
-        return response
+        return response, 0.0
 
     # last layer fingerprinting is done
     if response in [b"HTTP/1.1 200", b"HTTP/1.0 200"]:
-        return "200"
+        return "200", 0.0
 
     if len(response) == 0:
-        return "empty"
+        return "empty", 0.0
 
     try:
-        predicted_server = read_response(response, resp.responses)
+        with context.instrumentation.timer("scoring"):
+            scores = score_servers(response, reference_features(resp))
 
-        return predicted_server
+        return best_server(scores), score_margin(scores)
     except Exception as exception:
-        print(exception)
-        return "exception"
+        context.instrumentation.event("scoring_error", target=server_n, error=str(exception))
+        return "exception", 0.0
+
+def probe_until_settled(probes, server_n, server_p, path, evidence, context):
+    """
+        Sends the (reaction, entry) probes and adds their predictions to the
+        evidence. With a confidence threshold they are sent in waves of the
+        in-flight limit, and the rest are skipped once the evidence settles
+        the layer. Returns the predictions of the probes that were sent.
+    """
+
+    def probe(picked_response):
+        return fingerprint_probe(picked_response, server_n, server_p, path, context)
+
+    wave_size = (context.dispatcher.max_in_flight if context.confidence else len(probes)) or 1
+    predicted_servers = []
+
+    for start in range(0, len(probes), wave_size):
+        wave = probes[start:start + wave_size]
+        results = context.dispatcher.map(probe, [entry for _, entry in wave])
+        for (reaction, _), (predicted_server, margin) in zip(wave, results):
+            evidence.observe(reaction, predicted_server, margin)
+            predicted_servers.append(predicted_server)
+        if evidence.settled(context.confidence):
+            break
+
+    context.probes_saved += len(probes) - len(predicted_servers)
+    return predicted_servers
 
 
 def find_ordering_of_unordered_servers(server_n, server_p, path, unordered_list,
-                                       found_server_list_indexed, ordered):
+                                       found_server_list_indexed, ordered, context=None):
     """ finds the ordering for a given unordered list """
 
+    if context is None:
+        context = ScanContext()
+
     ## Attention: Phase 3 is not complete. # TODO: complete the Phase 3.
 
-    server_dict = {"cloudfront": 0, "cloudflare": 1, "fastly": 2, "akamai": 3,
-                "nginx": 4, "varnish": 5, "haproxy": 6, "apache": 7, "caddy": 8,
-                "envoy": 9, "ats": 10, "squid": 11, "tomcat": 12}
+    server_dict = Servers(context.repository.server_list).server_dict
 
     # Mark the ordered servers
     found_server_indexes = [idx for idx, value in
@@ -279,36 +342,36 @@ def find_ordering_of_unordered_servers(server_n, server_p, path, unordered_list,
     for unordered_server in unordered_list:
         error_server_indexes.append(server_dict[unordered_server])
 
-    # Iterate over the requests in behavior repository. 
-    with open("behavior_repository.out", "rb") as reader:
-        hashmap  = pickle.load(reader)
-
-        for i in hashmap:
-            lst = json.loads(i)
-            if 2 not in lst and 3 not in lst and 4 not in lst and 5 not in lst:
-                # If all the servers that we found in order forwards the request.
-                if all(lst[ind] == 1 for ind in found_server_indexes):
-                    # If all the servers that are unordered return an error response.
-                    if all(lst[error_ind] == 0 for error_ind in error_server_indexes):
-                        # Get request.
-                        picked_response = pick_request(lst)
-
-                        if picked_response:
-                            predicted_server = send_request_and_fingerprint(picked_response,
-                                                                            server_n, server_p, path)
-
-                            non_server_list = ["200", "too_long", "exception", "empty"]
-
-                            if predicted_server not in non_server_list:
-                                all_predicts.extend(predicted_server)
+    # Get the requests in behavior repository where all the servers that we found in
+    # order forward the request and all the unordered servers return an error.
+    probes = [(reaction, picked_response) for reaction, picked_response in
+              context.repository.query(forwarding=found_server_indexes,
+                                       erroring=error_server_indexes)
+              if picked_response]
+
+    # Send them concurrently, until the next layer is settled.
+    evidence = LayerEvidence(error_server_indexes, context.repository.server_list)
+    with context.instrumentation.timer("phase", phase=3):
+        predicted_servers = probe_until_settled(probes, server_n, server_p, path, evidence,
+                                                context)
+    context.instrumentation.count("probes", len(predicted_servers), phase=3)
+
+    non_server_list = ["200", "too_long", "exception", "empty"]
+    for predicted_server in predicted_servers:
+        if predicted_server not in non_server_list:
+            all_predicts.append(predicted_server)
 
     try:
         # If it finds the server ordering.
         if len(all_predicts) > 0:
             ordered = True
 
-            # Find the most common response.
-            next_layer = mode(all_predicts)
+            if evidence.settled(context.confidence):
+                next_layer = evidence.leader()[0]
+            else:
+                # Find the most common response.
+                next_layer = mode(all_predicts)
+            context.layer_confidence = evidence.confidence(next_layer)
             # Put the next layer server as a following server.
             layered_predicted_list = [next_layer]
             # Put the rest of the servers behind it.
@@ -326,18 +389,33 @@ def find_ordering_of_unordered_servers(server_n, server_p, path, unordered_list,
         layered_predicted_list.extend([elem for elem in unordered_list if elem != next_layer])
         return ("predict", layered_predicted_list, ordered)
 
-def find_layer(target_reaction, server_n, server_p, path, found_server_list_indexed):
+def find_layer(target_reaction, server_n, server_p, path, found_server_list_indexed,
+               context=None):
     """ for a given target reaction, picks a request and fingerprints the current layer """
 
+    if context is None:
+        context = ScanContext()
+
+    context.layer_confidence = None
+    # The next layer is one of the servers that were not found yet.
+    candidates = [idx for idx, value in enumerate(found_server_list_indexed) if value == 0]
+
     # Phase 1 starts
     # Searches for a request for a given target reaction in the behavior repository.
-    picked_response = pick_request(target_reaction)
+    picked_response = context.repository.pick(target_reaction)
 
     # If the behavior repository has the request.
     if picked_response:
 
         # Fingerprint the server by sending this request.
-        predicted_server = send_request_and_fingerprint(picked_response, server_n, server_p, path)
+        context.instrumentation.count("probes", 1, phase=1)
+        with context.instrumentation.timer("phase", phase=1):
+            predicted_server, margin = fingerprint_probe(picked_response, server_n, server_p,
+                                                         path, context)
+        context.phase1_probes.append((tuple(target_reaction), predicted_server))
+        evidence = LayerEvidence(candidates, context.repository.server_list)
+        evidence.observe(target_reaction, predicted_server, margin)
+        context.layer_confidence = evidence.confidence(predicted_server)
 
         # If it finds a server.
         if len(predicted_server) > 0:
@@ -347,135 +425,157 @@ def find_layer(target_reaction, server_n, server_p, path, found_server_list_inde
 
     # If the behavior repository has not the request.
     # Phase 2 starts
-    with open("behavior_repository.out", "rb") as reader:
-        hashmap  = pickle.load(reader)
-
-        all_unordered_servers = []
-
-        for i in hashmap:
-            lst = json.loads(i)
-            if 2 not in lst and 3 not in lst and 4 not in lst and 5 not in lst:
-                founded_server_indexes = [idx for idx, value in enumerate(found_server_list_indexed)
-                                          if value == 1]
-
-                if all(lst[ind] == 1 for ind in founded_server_indexes):
-                    picked_response = pick_request(lst)
-
-                    if picked_response:
-                        predicted_server = send_request_and_fingerprint(picked_response, server_n,
-                                                                        server_p, path)
-                        non_server_list = ["200", "too_long", "exception", "empty"]
-                        if predicted_server not in non_server_list:
-                            all_unordered_servers.append(predicted_server)
-
-        # Put all unordered servers in a list.
-        unordered_list = list(set(all_unordered_servers))
-
-        # The servers are currently not ordered.
-        ordered = False
-
-        # Check if unknown servers are present in the list.
-        # Check if there are more than one servers in the list.
-        if "unknown" not in unordered_list and len(unordered_list) > 1:
-            # Find the ordering of the unordered servers.
-            # Phase 3
-            return find_ordering_of_unordered_servers(server_n, server_p, path, unordered_list,
-                                                      found_server_list_indexed, ordered)
-
-        if len(unordered_list) == 1:
-            # The only server is returned as ordered.
-            return ("predict", unordered_list, True)
-
-        if len(unordered_list) > 0:
-            # Unknown is in the list, hence, it cannot find the ordering.
-            return ("predict", unordered_list, ordered)
-
-        return False
-
-def initial_redirect_check(server_n, path):
+    founded_server_indexes = [idx for idx, value in enumerate(found_server_list_indexed)
+                              if value == 1]
+
+    all_unordered_servers = []
+
+    # Get the requests where all the servers that we found forward the request.
+    probes = [(reaction, picked_response) for reaction, picked_response in
+              context.repository.query(forwarding=founded_server_indexes)
+              if picked_response]
+
+    evidence = LayerEvidence(candidates, context.repository.server_list,
+                             [reaction for reaction, _ in probes])
+    non_server_list = ["200", "too_long", "exception", "empty"]
+    instrumentation = context.instrumentation
+
+    if context.adaptive:
+        # Only send the probes that split the remaining candidates.
+        planner = ProbePlanner(probes, candidates, context.repository.server_list)
+        predicted_servers = []
+
+        with instrumentation.timer("phase", phase=2):
+            while not planner.done() and not evidence.settled(context.confidence):
+                planned = planner.next_probe()
+                if planned is None:
+                    break
+                predicted_server, margin = fingerprint_probe(planned[1], server_n, server_p,
+                                                             path, context)
+                planner.observe(planned[0], predicted_server)
+                evidence.observe(planned[0], predicted_server, margin)
+                predicted_servers.append(predicted_server)
+
+            # The next layer is known, the next call of find_layer looks behind it.
+            next_layer = planner.next_layer()
+            if next_layer is None and evidence.settled(context.confidence):
+                next_layer = evidence.leader()[0]
+            if next_layer is not None:
+                context.probes_saved += planner.saved
+                context.layer_confidence = evidence.confidence(next_layer)
+                instrumentation.count("probes", planner.sent, phase=2)
+                return next_layer
+
+            # The candidates cannot be told apart, send the rest of the probes.
+            remaining = planner.take_remaining()
+            predicted_remaining = probe_until_settled(remaining, server_n, server_p, path,
+                                                      evidence, context)
+            predicted_servers.extend(predicted_remaining)
+            # take_remaining counted the probes skipped by the evidence as sent.
+            planner.sent -= len(remaining) - len(predicted_remaining)
+        instrumentation.count("probes", planner.sent, phase=2)
+    else:
+        # Send them concurrently, until the next layer is settled.
+        with instrumentation.timer("phase", phase=2):
+            predicted_servers = probe_until_settled(probes, server_n, server_p, path, evidence,
+                                                    context)
+        instrumentation.count("probes", len(predicted_servers), phase=2)
+
+    if evidence.settled(context.confidence):
+        # The next call of find_layer looks behind the next layer.
+        next_layer, context.layer_confidence = evidence.leader()
+        return next_layer
+
+    for predicted_server in predicted_servers:
+        if predicted_server not in non_server_list:
+            all_unordered_servers.append(predicted_server)
+
+    # Put all unordered servers in a list.
+    unordered_list = list(set(all_unordered_servers))
+
+    # The servers are currently not ordered.
+    ordered = False
+
+    # Check if unknown servers are present in the list.
+    # Check if there are more than one servers in the list.
+    if "unknown" not in unordered_list and len(unordered_list) > 1:
+        # Find the ordering of the unordered servers.
+        # Phase 3
+        return find_ordering_of_unordered_servers(server_n, server_p, path, unordered_list,
+                                                  found_server_list_indexed, ordered, context)
+
+    if len(unordered_list) == 1:
+        # The only server is returned as ordered.
+        context.layer_confidence = evidence.confidence(unordered_list[0])
+        return ("predict", unordered_list, True)
+
+    if len(unordered_list) > 0:
+        # Unknown is in the list, hence, it cannot find the ordering.
+        return ("predict", unordered_list, ordered)
+
+    return False
+
+def initial_redirect_check(server_n, path, session=None, port=443):
     """ checking the initial redirects """
 
-    redirect_count = 0
-
-    try:
-        while True:
+    # follows up to 15 redirects, on the same connection while they stay on the same host.
+    return RedirectResolver(session, ttl=0).resolve(server_n, path, port)
 
-            # if redirect count is larger or equal to 15, redirect count exceeded.
-            if redirect_count >= 15:
-                return None, "redirect count exceeded"
-
-            # check if path is str, else decode it.
-            if isinstance(path,str):
-                pass
-            else:
-                path = path.decode()
+def verify_cached_chain(probes, server_n, server_p, path, context):
+    """
+        Sends again the Phase 1 probes of the first and the last layer of a
+        cached chain, the chain is unchanged if they have the same outcomes.
+        Layers found in Phase 2 or Phase 3 are not probed again, the TTL of
+        the cache bounds how long they are trusted.
+    """
 
-            # request used in the initial redirection check.
-            request = f"GET {path} HTTP/1.1\r\nHost: {server_n}\r\nUser-Agent: Wget/1.21.4\r\nConnection: close\r\n\r\n"
+    if not probes:
+        return False
 
-            # increase the redirect count.
-            redirect_count += 1
+    checks = [probes[0]] if len(probes) == 1 else [probes[0], probes[-1]]
+    for reaction, outcome in checks:
+        picked_response = context.repository.pick(reaction)
+        if not picked_response:
+            return False
+        if send_request_and_fingerprint(picked_response, server_n, server_p, path,
+                                        context) != outcome:
+            return False
+    return True
+
+def fingerprint(server_n, server_p, context=None):
+    """ main fingerprinting function """
 
-            path = path.encode()
+    if context is None:
+        context = ScanContext()
 
-            # socket programming.
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            # remove some checks.
-            ssl.match_hostname = lambda cert, hostname: True
-            ssl._create_default_https_context = ssl._create_unverified_context
-            context = ssl.create_default_context()
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-
-            response = b''
-
-            # send the request and receive a response.
-            with context.wrap_socket(sock, server_hostname=server_n) as ssock:
-                ssock.settimeout(10)
-                ssock.connect((server_n, 443))
-                ssock.sendall(request.encode())
-
-                while True:
-                    data = ssock.recv(2048)
-                    if not data:
-                        break
-                    response += data
-
-                ssock.close()
-
-            if len(response) == 0:
-                return server_n, path
-
-            # parse the response.
-            lines = response.split(b'\r\n')
-            status_line = lines[0]
-            headers = lines[1:]
-            status_code = int(status_line.split(b' ')[1])
-
-            # if status code is not redirect, return the hostname and path.
-            if status_code not in (301, 302, 303, 307, 308):
-                return server_n, path
-
-            # search for the "Location" header.
-            for header in headers:
-                if header.lower().startswith(b'location:'):
-                    # parse the url in the Location header.
-                    url = header.split(b':', 1)[1].strip()
-                    parse_results = urlparse(url)
-                    server_n = parse_results.hostname
-                    path = parse_results.path
+    # check initial redirects
+    with context.instrumentation.timer("initial_redirect_check"):
+        server_n, path = context.redirects.resolve(server_n, "/", server_p)
+
+    # a chain fingerprinted in a previous run only needs to be verified.
+    if context.result_cache is not None and server_n is not None:
+        cached = context.result_cache.get(server_n, server_p, path)
+        if cached is not None:
+            layers, probes = cached
+            if verify_cached_chain(probes, server_n, server_p, path, context):
+                context.instrumentation.count("result_cache", outcome="verified")
+                context.confidences = [None] * len(layers)
+                return layers
+            context.instrumentation.count("result_cache", outcome="changed")
+        else:
+            context.instrumentation.count("result_cache", outcome="miss")
 
-    except Exception:
-        return server_n, path
+        found_server_list = discover_layers(server_n, server_p, path, context)
+        context.result_cache.put(server_n, server_p, path, found_server_list,
+                                 context.phase1_probes)
+        return found_server_list
 
-def fingerprint(server_n, server_p):
-    """ main fingerprinting function """
+    return discover_layers(server_n, server_p, path, context)
 
-    # check initial redirects
-    server_n, path = initial_redirect_check(server_n, "/")
+def discover_layers(server_n, server_p, path, context):
+    """ fingerprints the layers one by one behind the resolved hostname and path """
 
-    server = Servers()
+    server = Servers(context.repository.server_list)
 
     # found server list holds the servers that untangle found.
     found_server_list = []
@@ -491,23 +591,29 @@ def fingerprint(server_n, server_p):
     while layer <= 2:
         # find the server
         predicted_server = find_layer(target_reaction, server_n, server_p,
-                                      path, found_server_list_indexed)
+                                      path, found_server_list_indexed, context)
 
         # if 
         if isinstance(predicted_server, tuple):
             if predicted_server[2] is True:
                 found_server_list.extend(predicted_server[1])
+                # only the first of the ordered servers is known to be the next layer.
+                context.confidences.append(context.layer_confidence)
+                context.confidences.extend([None] * (len(predicted_server[1]) - 1))
                 #found_server_list_indexed[server.server_dict[predicted_server[1][0]]] = 1
             else:
                 found_server_list.append(predicted_server[1])
+                context.confidences.append(None)
             break
         elif predicted_server in ["200", "too_long", "unknown", "exception", "empty"]:
             found_server_list.append(predicted_server)
+            context.confidences.append(None)
             break
         elif predicted_server:
             target_reaction[server.server_dict[predicted_server]] = 1
             found_server_list_indexed[server.server_dict[predicted_server]] = 1
             found_server_list.append(predicted_server)
+            context.confidences.append(context.layer_confidence)
 
             layer += 1
         else:
@@ -516,25 +622,111 @@ def fingerprint(server_n, server_p):
     # return fingerprinted servers
     return found_server_list
 
-def main():
-    """ main function """
+def rounded(confidences):
+    """ the layer confidences rounded for the output """
+
+    return [None if confidence is None else round(confidence, 4)
+            for confidence in confidences]
+
+def batch_fingerprint(arg):
+    """ fingerprints every target in the targets file and writes JSON lines """
+
+    if arg.output == "-":
+        output = sys.stdout
+    else:
+        output = open(arg.output, "w", encoding="utf-8")
+
+    repository = get_repository(arg.repository)
+    result_caches = []
+    # the redirect resolver of the process, created by make_fingerprint_fn.
+    resolvers = []
+
+    def make_fingerprint_fn():
+        # every scan process has its own connections, redirects and database handle.
+        session = session_from_args(arg)
+        result_cache = result_cache_from_args(arg)
+        if result_cache is not None:
+            result_caches.append(result_cache)
+        redirects = RedirectResolver(session, arg.redirect_ttl)
+        resolvers.append(redirects)
+
+        def fingerprint_target(target, port):
+            # a long batch picks up the probes appended to a repository log.
+            repository.refresh_if_due()
+            context = context_from_args(arg, session, repository, result_cache, redirects)
+            layers = fingerprint(target, port, context)
+            return {"layers": layers, "confidence": rounded(context.confidences)}
+        return fingerprint_target
+
+    def prepare_targets(targets):
+        # the redirects of the next window of targets are resolved concurrently.
+        return resolve_ahead(targets,
+                             lambda batch: resolvers[-1].prefetch(batch, 443, arg.workers),
+                             arg.redirect_window)
+
+    def route(target):
+        # the parent resolved the redirects, the target is sharded by its final host.
+        result = resolvers[-1].lookup(target)
+        if result is None or result[0] is None:
+            return target, None
+        host = result[0] if isinstance(result[0], str) else result[0].decode()
+        return host, result
+
+    def accept_hint(target, result):
+        # the scan process does not resolve the redirects of the target again.
+        resolvers[-1].remember(target, result)
 
-    # parsing arguments.
-    arg = arg_parse()
-    target_host = arg.target
-
-    if target_host == None:
-        print("Please use the -t flag and provide a hostname.")
-        exit()
+    try:
+        if arg.processes > 1:
+            prepare_repository(repository)
+            # the parent resolves the redirects ahead of the scan processes, which
+            # get their own resolver from make_fingerprint_fn.
+            resolvers.append(RedirectResolver(session_from_args(arg), arg.redirect_ttl))
+            stats = scan_targets_processes(prepare_targets(read_targets(arg.targets_file)),
+                                           make_fingerprint_fn, output, arg.processes,
+                                           workers=arg.workers, per_host=arg.per_host,
+                                           route=route, accept_hint=accept_hint)
+        else:
+            fingerprint_fn = make_fingerprint_fn()
+            stats = scan_targets(prepare_targets(read_targets(arg.targets_file)), fingerprint_fn,
+                                 output, workers=arg.workers, per_host=arg.per_host)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        for result_cache in result_caches:
+            result_cache.close()
+
+    print(f"Scanned {stats['scanned']} hosts ({stats['failed']} failed) in "
+          f"{stats['elapsed']:.2f} s, {stats['hosts_per_sec']:.2f} hosts/sec", file=sys.stderr)
+    if stats.get("crashed"):
+        print(f"{stats['crashed']} scan processes crashed, some of their targets were not "
+              "scanned", file=sys.stderr)
+
+def fingerprint_target(arg):
+    """ fingerprints the -t target and prints its layers """
 
     # call fingerprint function.
-    results = fingerprint(target_host, 443)
+    session = session_from_args(arg)
+    result_cache = result_cache_from_args(arg)
+    context = context_from_args(arg, session, get_repository(arg.repository), result_cache)
+    try:
+        results = fingerprint(arg.target, 443, context)
+    finally:
+        if result_cache is not None:
+            result_cache.close()
+    print(f"Response cache: {context.response_cache.hits} hits, "
+          f"{context.response_cache.misses} misses", file=sys.stderr)
+    if context.adaptive or context.confidence:
+        print(f"Adaptive probing saved {context.probes_saved} probes", file=sys.stderr)
 
     # iterate over the results.
-    for layer_num, server in enumerate(results):
+    for layer_num, (server, confidence) in enumerate(zip(results, context.confidences)):
         # if server is str, we know it is an ordered layer.
         if isinstance(server, str):
-            print("Layer " + str(layer_num+1) + ":", server)
+            if confidence is None:
+                print("Layer " + str(layer_num+1) + ":", server)
+            else:
+                print("Layer " + str(layer_num+1) + ":", server, f"(confidence {confidence:.2f})")
         # if server is list, we know it is an unordered list of servers.
         elif isinstance(server, list):
             print("Unordered Layers:")
@@ -543,5 +735,54 @@ def main():
         else:
             print("something wrong")
 
+def setup_instrumentation(arg):
+    """
+        Sends the timings and counters of the process to the sinks selected on
+        the command line. Returns the registry (None without --stats) and the
+        metrics file to close (None if there is none).
+    """
+
+    sinks = []
+    registry = None
+    metrics_output = None
+
+    if arg.metrics == "-":
+        sinks.append(JSONLinesSink(sys.stderr))
+    elif arg.metrics:
+        metrics_output = open(arg.metrics, "w", encoding="utf-8")
+        sinks.append(JSONLinesSink(metrics_output))
+
+    if arg.stats:
+        registry = Registry()
+        sinks.append(registry)
+
+    set_instrumentation(Instrumentation(sinks))
+    return registry, metrics_output
+
+def main():
+    """ main function """
+
+    # parsing arguments.
+    arg = arg_parse()
+    target_host = arg.target
+
+    if arg.targets_file is None and target_host == None:
+        print("Please use the -t flag and provide a hostname or the -f flag and provide a file.")
+        exit()
+
+    registry, metrics_output = setup_instrumentation(arg)
+    try:
+        # batch mode.
+        if arg.targets_file is not None:
+            batch_fingerprint(arg)
+        else:
+            fingerprint_target(arg)
+    finally:
+        if registry is not None:
+            for line in registry.summary():
+                print(line, file=sys.stderr)
+        if metrics_output is not None:
+            metrics_output.close()
+
 if __name__ == '__main__':
     main()